@@ -0,0 +1,346 @@
+'''offline end-to-end benchmark of a full triage round, using a
+synthetic mailbox on an in-process fake IMAP server.  Run as:
+
+  python respectmail/benchmark.py [NMESSAGES ...]
+
+Reports wall time, IMAP commands issued, bytes transferred and
+peak memory for get_updates, update_threads, triage and purge_blacklist.
+With --ingest, instead reports database ingest rate (rows/sec) of
+save_headers, save_verdicts and save_moves.  With --answered, compares
+get_answered_messages against the self-join query it replaced
+(default 100000 and 1000000 rows).  With --fusion, times the subject
+ROC and subject-fusion stages (default 200000 rows).  With --rebuild,
+compares thread labelling via dict-of-sets graph and DFS against CSR
+connected components, and times rebuild_threads including its
+write-back (default 1000000 rows).
+'''
+import os
+import sys
+import random
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy
+import db
+import imap
+import fakeimap
+
+ME = 'me@example.com'
+HOST = 'imap.benchmark.invalid'
+
+def make_header(msgNum, sender, recipients, subject, date, references=(),
+                rng=random):
+    'generate realistic header text, including the usual bulky headers'
+    lines = ['Received: from mx%d.example.net (mx%d.example.net [10.0.%d.%d])'
+             '\r\n\tby mail.example.com with ESMTPS id %08x;\r\n\t%s'
+             % (i, i, rng.randint(0, 255), rng.randint(0, 255),
+                rng.getrandbits(32), date) for i in range(3)]
+    lines.append('DKIM-Signature: v=1; a=rsa-sha256; d=example.net; s=sel;'
+                 '\r\n\tb=%s' % ''.join([rng.choice('abcdefghABCDEFGH0123456789')
+                                          for i in range(340)]))
+    lines += ['From: %s' % sender,
+              'To: %s' % ', '.join(recipients),
+              'Subject: %s' % subject,
+              'Date: %s' % date,
+              'Message-ID: <bench%d@example.net>' % msgNum]
+    if references:
+        lines.append('In-Reply-To: %s' % references[-1])
+        lines.append('References: %s' % ' '.join(references))
+    lines += ['MIME-Version: 1.0', 'Content-Type: text/plain; charset=utf-8']
+    return '\r\n'.join(lines) + '\r\n\r\nbenchmark message body\r\n'
+
+def generate_messages(n, nSenders=None, replyP=0.4, myReplyP=0.3,
+                      newFraction=0.05, seed=1):
+    '''generate n synthetic messages with realistic threads, as
+    [(folder, text, flags),].  Senders follow a heavy-tailed popularity
+    distribution; a third of them are "junk" senders I never answer.
+    The newest newFraction of incoming messages are left unread in INBOX'''
+    rng = random.Random(seed)
+    if nSenders is None:
+        nSenders = max(10, n / 20)
+    senders = ['sender%d@example%d.net' % (i, i % 97) for i in range(nSenders)]
+    weights = [1. / (i + 1) for i in range(nSenders)]
+    total = sum(weights)
+    cumulative = []
+    s = 0.
+    for w in weights:
+        s += w
+        cumulative.append(s / total)
+    def pick_sender():
+        x = rng.random()
+        lo, hi = 0, nSenders - 1
+        while lo < hi: # binary search on cumulative weights
+            mid = (lo + hi) / 2
+            if cumulative[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return senders[lo]
+    junk = frozenset(senders[2::3])
+    threads = [] # [(subject, [msgid,], participants)]
+    messages = []
+    t0 = time.mktime((2010, 1, 1, 0, 0, 0, 0, 0, -1))
+    for i in range(n):
+        date = time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                             time.gmtime(t0 + i * 900))
+        if threads and rng.random() < replyP:
+            subject, refs, sender = threads[max(0, len(threads) - 1 -
+                                                int(rng.expovariate(0.1)))]
+            if sender not in junk and rng.random() < myReplyP:
+                frm, to = ME, [sender]
+            else:
+                frm, to = sender, [ME]
+            subject = 'Re: ' + subject
+            refs = refs + ['<bench%d@example.net>' % i]
+        else:
+            sender = pick_sender()
+            subject = 'topic %d from %s' % (i, sender.split('@')[0])
+            refs = ['<bench%d@example.net>' % i]
+            frm, to = sender, [ME]
+            threads.append((subject, refs, sender))
+        text = make_header(i, frm, to, subject, date, refs[:-1], rng)
+        if frm == ME:
+            messages.append(('Sent', text, ('\\Seen',)))
+        elif i >= n * (1. - newFraction):
+            messages.append(('INBOX', text, ()))
+        else:
+            messages.append(('Closed', text, ('\\Seen',)))
+    return messages
+
+def peak_memory():
+    'peak resident set size of this process, in MB'
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+@contextmanager
+def temp_triage_db():
+    'new TriageDB in a temporary file, closed and deleted afterwards'
+    fd, dbfile = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        triageDB = db.TriageDB(dbfile, createTables=True, myAddrs=(ME,))
+        try:
+            yield triageDB
+        finally:
+            triageDB.conn.close()
+    finally:
+        os.remove(dbfile)
+
+def run_benchmark(n=1000, pipelined=False, headerFields=imap.HEADER_FIELDS,
+                  seed=1, goodVerdicts=(imap.REQUESTS, imap.FYI, imap.CLOSED)):
+    '''run one full triage round on n synthetic messages; returns
+    [(phase, seconds, ncommands, nbytes),], peak memory (MB)'''
+    store = fakeimap.FakeIMAPStore(HOST)
+    for folder, text, flags in generate_messages(n, seed=seed):
+        store.append(folder, text, flags)
+    with temp_triage_db() as triageDB:
+        srv = imap.IMAPServer(HOST, ME, password='benchmark',
+                              pipelined=pipelined, headerFields=headerFields)
+        if pipelined:
+            srv.server.clientClass = fakeimap.FakePipelinedIMAPClient
+        else:
+            srv.server.clientClass = fakeimap.FakeIMAPClient
+        srv.create_mailboxes()
+        results = []
+        for phase, f in (('get_updates', lambda: srv.get_updates(triageDB)),
+                         ('update_threads',
+                          lambda: triageDB.update_threads(goodVerdicts)),
+                         ('triage', lambda: srv.triage(triageDB)),
+                         ('purge_blacklist',
+                          lambda: srv.purge_blacklist(triageDB))):
+            store.reset_stats()
+            start = time.time()
+            f()
+            results.append((phase, time.time() - start, store.ncommands(),
+                            store.bytes))
+    return results, peak_memory()
+
+def run_ingest_benchmark(n=100000, seed=1):
+    '''time saving n synthetic messages, then verdicts and moves for
+    all of them, in one transaction; returns [(step, rows/sec),]'''
+    msgHeaders = []
+    for i, (folder, text, flags) in enumerate(generate_messages(n, seed=seed)):
+        msg = imap.HeaderRecord(text)
+        msg._imapFlags = flags
+        msgHeaders.append((i + 1, msg))
+    with temp_triage_db() as triageDB:
+        results = []
+        triageDB.begin_batch()
+        for step, f in (('save_headers',
+                         lambda: triageDB.save_headers(msgHeaders)),
+                        ('save_verdicts',
+                         lambda: triageDB.save_verdicts(msgHeaders, 'FYI',
+                                                        imap.FYI)),
+                        ('save_moves', 
+                         lambda: triageDB.save_moves(msgHeaders, 'Closed'))):
+            start = time.time()
+            f()
+            results.append((step, n / (time.time() - start)))
+        triageDB.end_batch()
+    return results
+
+SELFJOIN_ANSWERED = '''select t1.id, t1.msgID from messages t1, messages t2
+  where t2.fromMe=1 and t1.threadID=t2.threadID and t1.date < t2.date
+  and t1.mailbox!="Closed" and t1.mailbox!="Sent" and t1.serverID>0'''
+
+def generate_thread_rows(n, openFraction=0.02, commonP=0.2, seed=1):
+    '''generate n synthetic threaded message rows, as
+    [(msgid, threadID, fromMe, date, mailbox, nsubject),].  A fraction
+    commonP of threads reuse one of n / 100 common subjects'''
+    rng = random.Random(seed)
+    t0 = time.mktime((2010, 1, 1, 0, 0, 0, 0, 0, -1))
+    nCommon = max(10, n / 100)
+    rows = []
+    threadID = None
+    for i in range(1, n + 1):
+        if threadID is None or rng.random() < 0.3:
+            threadID = i # start a new thread
+            if rng.random() < commonP:
+                subject = 'weekly meeting %d' % rng.randrange(nCommon)
+            else:
+                subject = 'topic %d' % i
+        fromMe = rng.random() < 0.2
+        if fromMe:
+            mailbox = 'Sent'
+        elif rng.random() < openFraction:
+            mailbox = rng.choice(('INBOX', 'Requests', 'FYI'))
+        else:
+            mailbox = 'Closed'
+        rows.append(('<thread%d@example.net>' % i, threadID, fromMe,
+                     int(t0 + i * 60), mailbox,
+                     subject))
+    return rows
+
+def save_thread_rows(c, rows):
+    c.executemany('''insert into messages (msgid, serverID, threadID,
+                     fromMe, date, mailbox, nsubject)
+                     values (?,1,?,?,?,?,?)''', rows)
+
+def run_answered_benchmark(n=100000, openFraction=0.02, seed=1):
+    '''time answered-message lookup on n synthetic threaded rows, via
+    the old self-join and via thread_replies; returns
+    [(method, seconds, nanswered),]'''
+    rows = generate_thread_rows(n, openFraction, seed=seed)
+    with temp_triage_db() as triageDB:
+        c = triageDB.cursor
+        save_thread_rows(c, rows)
+        db.rebuild_thread_replies(c)
+        triageDB.commit()
+        results = []
+        def selfjoin():
+            c.execute(SELFJOIN_ANSWERED)
+            return dict([(msgID, uid) for uid, msgID in c.fetchall()])
+        for method, f in (('self-join', selfjoin),
+                          ('thread_replies',
+                           lambda: triageDB.get_answered_messages())):
+            start = time.time()
+            answered = f()
+            results.append((method, time.time() - start, len(answered)))
+    return results
+
+def run_fusion_benchmark(n=200000, seed=1):
+    '''time the subject ROC and fusion stages on n synthetic threaded
+    rows; returns [(step, seconds, nresults),]'''
+    rows = generate_thread_rows(n, seed=seed)
+    with temp_triage_db() as triageDB:
+        c = triageDB.cursor
+        save_thread_rows(c, rows)
+        db.migrate_thread_forest(c) # seed forest from threadID labels
+        triageDB.commit()
+        msgThread = db.load_threads(c)[0]
+        data = {}
+        def step(name, f):
+            start = time.time()
+            data[name] = f()
+            results.append((name, time.time() - start, len(data[name])))
+        results = []
+        step('get_subjects', lambda: db.get_subjects(c))
+        step('threadtime_roc', lambda: db.threadtime_roc(c, msgThread))
+        step('subject_unreliability',
+             lambda: db.subject_unreliability(data['get_subjects'],
+                                              data['threadtime_roc'])[1])
+        step('subjects_roc',
+             lambda: db.subjects_roc(data['get_subjects'], msgThread)[0])
+        step('get_subject_fusions',
+             lambda: db.get_subject_fusions(c, msgThread))
+        step('thread_new_messages',
+             lambda: db.thread_new_messages(c,
+                                            data['get_subject_fusions'])[0])
+    return results
+
+def run_rebuild_benchmark(n=1000000, seed=1,
+                          goodVerdicts=(imap.REQUESTS, imap.FYI, imap.CLOSED)):
+    '''time full rethreading of n synthetic rows, each referencing the
+    first message of its thread; returns [(method, seconds, nthreads),]'''
+    rows = generate_thread_rows(n, seed=seed)
+    with temp_triage_db() as triageDB:
+        c = triageDB.cursor
+        save_thread_rows(c, rows)
+        c.executemany('insert into msgrefs values (?,?)',
+                      [(i + 1, '<thread%d@example.net>' % t[1])
+                       for i, t in enumerate(rows) if t[1] != i + 1])
+        triageDB.commit()
+        def dict_graph():
+            uidDict, msgDict = db.get_references(c, False)
+            return db.get_threads(db.build_graph(uidDict, msgDict))[0]
+        def csr_graph():
+            c.execute('select id from messages order by id')
+            ids = numpy.array([t[0] for t in c.fetchall()])
+            threadIDs = db.label_threads(ids, *db.get_edge_arrays(c))
+            return set(threadIDs[threadIDs >= 0].tolist())
+        results = []
+        for method, f in (('dict graph + DFS', dict_graph),
+                          ('CSR components', csr_graph),
+                          ('rebuild_threads',
+                           lambda: triageDB.rebuild_threads(goodVerdicts))):
+            start = time.time()
+            threads = f()
+            if threads is None:
+                threads = set(triageDB.msgThread.values())
+            results.append((method, time.time() - start, len(threads)))
+    return results
+
+def print_report(n, results, peakMB):
+    print '\n%d messages: peak memory %.1f MB' % (n, peakMB)
+    print '%-16s %10s %10s %14s' % ('phase', 'seconds', 'commands', 'bytes')
+    for phase, seconds, ncommands, nbytes in results:
+        print '%-16s %10.3f %10d %14d' % (phase, seconds, ncommands, nbytes)
+    print '%-16s %10.3f %10d %14d' % ('total',
+                                      sum([t[1] for t in results]),
+                                      sum([t[2] for t in results]),
+                                      sum([t[3] for t in results]))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if '--answered' in args:
+        args.remove('--answered')
+        for n in [int(a) for a in args] or [100000, 1000000]:
+            print '\n%d messages:' % n
+            for method, seconds, nanswered in run_answered_benchmark(n):
+                print '%-16s %10.3f sec %8d answered' % (method, seconds,
+                                                         nanswered)
+    elif '--fusion' in args:
+        args.remove('--fusion')
+        for n in [int(a) for a in args] or [200000]:
+            print '\n%d messages:' % n
+            for step, seconds, nresults in run_fusion_benchmark(n):
+                print '%-22s %10.3f sec %8d results' % (step, seconds,
+                                                       nresults)
+    elif '--rebuild' in args:
+        args.remove('--rebuild')
+        for n in [int(a) for a in args] or [1000000]:
+            print '\n%d messages:' % n
+            for method, seconds, nthreads in run_rebuild_benchmark(n):
+                print '%-18s %10.3f sec %8d threads' % (method, seconds,
+                                                       nthreads)
+            print 'peak memory %.1f MB' % peak_memory()
+    elif '--ingest' in args:
+        args.remove('--ingest')
+        for n in [int(a) for a in args] or [100000]:
+            print '\n%d messages:' % n
+            for step, rate in run_ingest_benchmark(n):
+                print '%-16s %10.0f rows/sec' % (step, rate)
+    else:
+        for n in [int(a) for a in args] or [1000]:
+            results, peakMB = run_benchmark(n)
+            print_report(n, results, peakMB)
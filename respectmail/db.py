@@ -1,12 +1,18 @@
 import mailbox
 import os
 import email
+import email.parser
 import sqlite3
 import json
-import time
-import datetime
-from math import log, exp, isnan
-from scipy import special, stats
+import calendar
+import re
+import hashlib
+import zlib
+from collections import OrderedDict
+from itertools import chain
+from math import log, exp
+from scipy import special, stats, sparse
+from scipy.sparse import csgraph
 import numpy
 #import warnings
 
@@ -15,21 +21,27 @@ class TriageDB(object):
     def __init__(self, dbfile='maildir.db', createTables=False, myAddrs=()):
         self.conn = db_connect(dbfile)
         self.cursor = self.conn.cursor()
+        self._batchDepth = 0
         if createTables:
-            create_messages_table(self.cursor)
-            create_addrs_table(self.cursor)
-            create_addrs_table(self.cursor, 'junkaddrs')
-            create_addrs_table(self.cursor, 'verdictaddrs')
-            save_myaddrs_table(self.cursor, myAddrs)
-            save_myaddrs_table(self.cursor, tableName='notjunk')
-            save_myaddrs_table(self.cursor, tableName='vip')
-            save_myaddrs_table(self.cursor, tableName='blacklist')
+            create_tables(self.cursor, myAddrs)
+            self.commit()
+        migrate_db(self.cursor)
+        self.commit()
+        self.myAddrs = get_myaddrs(self.cursor)
+
+    def commit(self):
+        'commit now, unless inside begin_batch() ... end_batch()'
+        if not self._batchDepth:
             self.conn.commit()
-        myAddrs = set()
-        self.cursor.execute('select * from myaddrs')
-        for t in self.cursor.fetchall():
-            myAddrs.add(t[0].lower())
-        self.myAddrs = myAddrs
+
+    def begin_batch(self):
+        'defer commits until the matching end_batch(), i.e. one transaction'
+        self._batchDepth += 1
+
+    def end_batch(self):
+        'commit everything since the outermost begin_batch()'
+        self._batchDepth -= 1
+        self.commit()
 
     def save_headers(self, msgHeaders, mailbox='INBOX', fromMe=False, 
                      serverID=1, **kwargs):
@@ -40,59 +52,92 @@ class TriageDB(object):
             kwargs['from_me_f'] = None
         save_messages(self.cursor, msgHeaders, fromMe=fromMe, mboxName=mailbox,
                       myAddrs=self.myAddrs, serverID=serverID, **kwargs)
-        self.conn.commit()
+        self.commit()
 
     def save_verdicts(self, msgHeaders, mailbox, verdict, overwrite=True,
                       serverID=1):
         'user has triaged messages to mailbox, so record that verdict'
         save_verdicts(self.cursor, msgHeaders, mailbox, verdict, overwrite,
                       myAddrs=self.myAddrs, serverID=serverID)
-        self.conn.commit()
-
-    def update_threads(self, goodVerdicts):
-        'extend thread analysis to NEW messages and verdicts'
-        self.threadMsgs, self.msgThread, self.myThreads, self.low, self.high = \
-            reanalyze_threads(self.cursor)
-        self.conn.commit()
-        self.verdicts = get_sender_verdicts(self.cursor, goodVerdicts)
-        create_addrs_table(self.cursor, 'verdictaddrs')
-        save_addrs(self.cursor, self.verdicts, 'verdictaddrs')
-        self.conn.commit()
+        self.commit()
+
+    def get_sync_state(self, mailbox, serverID=1):
+        'get (uidvalidity, lastUID, modseq) from last sync of mailbox, or None'
+        return get_sync_state(self.cursor, mailbox, serverID)
+
+    def save_sync_state(self, mailbox, state, serverID=1):
+        'record (uidvalidity, lastUID, modseq) for mailbox after a sync'
+        save_sync_state(self.cursor, mailbox, state, serverID)
+        self.commit()
+
+    def save_flags(self, flagChanges, mailbox, serverID=1):
+        'update flags of messages {serverMsg:imapFlags} in mailbox'
+        if flagChanges:
+            save_flags(self.cursor, flagChanges, mailbox, serverID)
+            self.commit()
+
+    def update_threads(self, goodVerdicts, fuseSubjects=False):
+        '''extend thread analysis to NEW messages and verdicts, updating
+        sender stats and scores only where they changed'''
+        self.msgThread, self.myThreads = \
+            reanalyze_threads(self.cursor, goodVerdicts,
+                              getattr(self, 'msgThread', None), fuseSubjects,
+                              getattr(self, 'myThreads', None))
+        self.commit()
+
+    def update_verdicts(self, goodVerdicts):
+        'update verdictaddrs (and sender stats) from changed verdicts'
+        senders = update_sender_stats(self.cursor, {}, goodVerdicts)
+        score_senders(self.cursor, senders)
+        self.commit()
 
     def get_triage(self, requestP=0.05, junkP=0.05, fyiReplies=1):
-        'get triage of email addresses into likely requests, fyi, junk sets'
-        if not hasattr(self, 'high'):
-            self.cursor.execute('select pval, nrelevant, ntotal, email from addrs')
-            self.high = self.cursor.fetchall()
-        requestAddrs = frozenset([t[3] for t in self.high if t[0] < requestP])
-        fyiAddrs = frozenset([t[3] for t in self.high if t[1] >= fyiReplies])
+        '''get triage of email addresses into likely requests, fyi, junk
+        sets, of address ids (see get_address_ids())'''
+        self.cursor.execute('select id from addrs where pval<?', (requestP,))
+        requestAddrs = frozenset([t[0] for t in self.cursor.fetchall()])
+        self.cursor.execute('select id from addrs where nrelevant>=?',
+                            (fyiReplies,))
+        fyiAddrs = frozenset([t[0] for t in self.cursor.fetchall()])
         junkAddrs = get_junkaddrs(self.cursor, junkP)
         blackAddrs = get_blacklist(self.cursor)
         return requestAddrs, fyiAddrs, junkAddrs, blackAddrs
 
     def save_moves(self, msgHeaders, toBox='Junk', tableName='messages'):
         'record mailbox move for the set of messages'
-        for j,msg in msgHeaders:
-            self.cursor.execute('update %s set mailbox=?,serverMsg=NULL where id=?'
-                                % tableName, (toBox, msg.uid))
-        self.conn.commit()
+        self.cursor.executemany('update %s set mailbox=?,serverMsg=NULL where id=?'
+                                % tableName,
+                                [(toBox, msg.uid) for j,msg in msgHeaders])
+        self.commit()
 
     def blacklist(self, msgHeaders, blacklistTable='blacklist'):
         'add senders of these messages to our blacklist'
         bl = [get_headers_sender(t[1]) for t in msgHeaders]
-        save_myaddrs_table(self.cursor, bl, blacklistTable)
-        self.conn.commit()
+        save_myaddrs_table(self.cursor, [a for a in bl if a], blacklistTable)
+        self.commit()
+
+    def get_address_ids(self, emails):
+        'get {email:id} for the known addresses among emails'
+        return get_address_ids(self.cursor, emails)
+
+    def rebuild_threads(self, goodVerdicts, fuseSubjects=False):
+        '''rethread all messages from scratch (e.g. after a bulk import),
+        then recount and rescore all senders.  Pass the same fuseSubjects
+        as to update_threads(), or subject fusions are discarded'''
+        self.msgThread, self.myThreads = \
+            rebuild_threads(self.cursor, goodVerdicts, fuseSubjects)
+        self.commit()
+
+    def delete_dups(self):
+        '''delete later copies of duplicate messages (see get_dup_messages()),
+        keeping threads and sender stats consistent'''
+        delete_dups(self.cursor, get_dup_messages(self.cursor))
+        self._load_threads()
+        self.commit()
 
     def _load_threads(self, tableName='messages'):
         'get thread mapping and set of my threads from db'
-        self.cursor.execute('select id, threadID from %s where threadID is not null' % tableName)
-        d = {}
-        for uid, threadID in self.cursor.fetchall():
-            d[uid] = threadID
-        self.msgThread = d
-        self.cursor.execute('select threadID from %s where fromMe=1 and threadID is not null'
-                            % tableName)
-        self.myThreads = set([t[0] for t in self.cursor.fetchall()])
+        self.msgThread, self.myThreads = load_threads(self.cursor, tableName)
 
     def get_answered_messages(self):
         return get_answered_messages(self.cursor)
@@ -104,13 +149,50 @@ def iter_mailboxes(mailDir):
             yield mailbox.Maildir(path, factory=None)
 
 
+class LRUCache(object):
+    'mapping that keeps only the maxsize most recently used items'
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.d = OrderedDict()
+    def __getitem__(self, k):
+        v = self.d.pop(k) # raises KeyError if absent
+        self.d[k] = v # now most recently used
+        return v
+    def __setitem__(self, k, v):
+        self.d.pop(k, None)
+        self.d[k] = v
+        if len(self.d) > self.maxsize:
+            self.d.popitem(last=False) # drop least recently used
+
+_parseCache = LRUCache() # {header value(s):parsed}
+
+def parse_address(s, cache=_parseCache):
+    'cached email.utils.parseaddr(s), with lowercase address'
+    try:
+        return cache[s]
+    except KeyError:
+        name, addr = email.utils.parseaddr(s)
+        cache[s] = t = (name, addr.lower())
+        return t
+
+def parse_addresses(values, cache=_parseCache):
+    '''cached email.utils.getaddresses(values), as frozenset of
+    lowercase addresses'''
+    key = tuple(values)
+    try:
+        return cache[key]
+    except KeyError:
+        cache[key] = addrs = frozenset([t[1].lower() for t in
+                                        email.utils.getaddresses(key)])
+        return addrs
+
 def canonical_name(a):
-    name,addr = email.utils.parseaddr(a)
+    name,addr = parse_address(a)
     if ',' in name:
         l = name.split(',')
         if len(l) == 2:
             name = ' '.join((l[1].strip(), l[0].strip()))
-    return name, addr.lower()
+    return name, addr
 
 
 def jost_pvalue(pvalues):
@@ -124,51 +206,155 @@ def jost_pvalue(pvalues):
     m = logR.max()
     return exp(logk + m + log(numpy.exp(logR - m).sum()))
 
+def jost_pvalues(pvalues, starts):
+    '''jost_pvalue() of each segment pvalues[starts[k]:starts[k + 1]],
+    computed for all segments in one pass'''
+    pvalues = numpy.asarray(pvalues, dtype=float)
+    if not len(pvalues):
+        return numpy.zeros(0)
+    counts = numpy.diff(numpy.r_[starts, len(pvalues)])
+    segment = numpy.repeat(numpy.arange(len(starts)), counts)
+    i = numpy.arange(len(pvalues)) - numpy.repeat(starts, counts)
+    logk = numpy.add.reduceat(numpy.log(pvalues), starts)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        logR = (numpy.log(-logk)[segment] * i) - special.gammaln(i + 1)
+        m = numpy.maximum.reduceat(logR, starts)
+        p = numpy.exp(logk + m + numpy.log(numpy.add.reduceat(
+            numpy.exp(logR - m[segment]), starts)))
+    return numpy.where(logk >= 0., 1., p)
+
 def get_junkaddrs(c, p=0.05, maxreply=0, tableName='junkaddrs',
-                  verdictTable='verdictaddrs'):
-    c.execute('select email from notjunk')
-    notjunk = frozenset([t[0] for t in c.fetchall()])
-    c.execute('select email from %s where pval<? and nrelevant<=?'
-              % tableName, (p, maxreply))
-    junkaddrs = set([t[0] for t in c.fetchall() if t[0] not in notjunk])
+                  verdictTable='verdictaddrs', notjunkTable='notjunk'):
+    'get set of likely junk address ids, excluding notjunk, in one query'
+    sql = 'select id from %s a where pval<? and nrelevant<=? and not exists (select 1 from %s n where n.id=a.id)'
     if verdictTable:
-        c.execute('select email from %s where pval<? and nrelevant<=?' 
-                  % verdictTable, (log(p / (1. - p)), maxreply))
-        for t in c.fetchall():
-            if t[0] not in notjunk:
-                junkaddrs.add(t[0])
-    return junkaddrs
-
-def get_blacklist(c, blacklistTable='blacklist'):
-    c.execute('select email from notjunk')
-    notjunk = frozenset([t[0] for t in c.fetchall()])
-    blackaddrs = set()
-    c.execute('select email from %s' % blacklistTable)
-    for t in c.fetchall():
-        if t[0] not in notjunk:
-            blackaddrs.add(t[0])
-    return blackaddrs
+        c.execute(' union '.join((sql % (tableName, notjunkTable),
+                                  sql % (verdictTable, notjunkTable))),
+                  (p, maxreply, log(p / (1. - p)), maxreply))
+    else:
+        c.execute(sql % (tableName, notjunkTable), (p, maxreply))
+    return set([t[0] for t in c.fetchall()])
+
+def get_blacklist(c, blacklistTable='blacklist', notjunkTable='notjunk'):
+    c.execute('select id from %s b where not exists (select 1 from %s n where n.id=b.id)'
+              % (blacklistTable, notjunkTable))
+    return set([t[0] for t in c.fetchall()])
 
 def get_addrs(c, query='where pval<0.05', tableName='addrs'):
-    'get set of addrs below specified p-value cutoff'
-    c.execute('select email from %s %s' % (tableName, query))
+    'get set of address ids below specified p-value cutoff'
+    c.execute('select id from %s %s' % (tableName, query))
     return frozenset([t[0] for t in c.fetchall()])
 
+# headers kept in the messages.headers blob; received has its own column
+STORED_HEADERS = ('from', 'to', 'cc', 'resent-to', 'resent-cc', 'date',
+                  'message-id', 'references', 'in-reply-to', 'subject')
+
+def encode_headers(d, headerFields=STORED_HEADERS, level=6):
+    '''zlib-compressed JSON of the headerFields (all, if None) of
+    headers dict d, to be stored as a blob via sqlite3.Binary()'''
+    if headerFields is not None:
+        d = dict([(k, d[k]) for k in headerFields if k in d])
+    return zlib.compress(json.dumps(d), level)
+
+def decode_headers(headers):
+    'get headers dict from the stored column, compressed or legacy JSON text'
+    if isinstance(headers, buffer): # compressed blob
+        headers = zlib.decompress(headers)
+    return json.loads(headers)
+
+def get_message_headers(c, uid, tableName='messages'):
+    'get stored headers dict of message uid, or None'
+    c.execute('select headers from %s where id=?' % tableName, (uid,))
+    t = c.fetchone()
+    if t and t[0] is not None:
+        return decode_headers(t[0])
+
 def get_headers_sender(headers):
     try:
-        return email.utils.parseaddr(headers['from'])[1].lower()
+        return parse_address(headers['from'])[1]
     except KeyError:
         None
 
+def create_addresses_table(c, tableName='addresses'):
+    'intern each normalized (lowercase) email address as an integer id'
+    c.execute('''create table if not exists %s
+            (id integer primary key,
+            email text unique not null)''' % tableName)
+
+def stage_emails(c, emails, tmpTable='email_tmp'):
+    'load email addresses into a temp table for set-based queries'
+    _temp_table(c, tmpTable, 'email text primary key')
+    c.executemany('insert or ignore into %s values (?)' % tmpTable,
+                  [(a,) for a in emails])
+
+def get_address_ids(c, emails, create=False, tableName='addresses'):
+    '''get {email:id} for emails in one query; if create, first adds
+    any that are not yet in the addresses table'''
+    stage_emails(c, emails)
+    if create:
+        c.execute('insert or ignore into %s (email) select email from email_tmp'
+                  % tableName)
+    c.execute('select a.email, a.id from %s a, email_tmp t where a.email=t.email'
+              % tableName)
+    return dict(c.fetchall())
+
 # conversions
 # from, to
 # date
 # message-id
 # flags
 
-def db_connect(dbfile):
-    'get connection that supports auto datetime conversion'
-    return sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+FLAG_SEEN = 1 # flagbits values
+FLAG_ANSWERED = 2
+FLAG_FORWARDED = 4
+FLAG_FLAGGED = 8
+FLAG_DELETED = 16
+FLAG_REPLIED = FLAG_ANSWERED | FLAG_FORWARDED # I participated
+
+imapFlagBits = {'\\seen':FLAG_SEEN, '\\answered':FLAG_ANSWERED,
+                '$forwarded':FLAG_FORWARDED, '\\flagged':FLAG_FLAGGED,
+                '\\deleted':FLAG_DELETED}
+maildirFlagBits = {'S':FLAG_SEEN, 'R':FLAG_ANSWERED, 'P':FLAG_FORWARDED,
+                   'F':FLAG_FLAGGED, 'T':FLAG_DELETED}
+
+def flag_bits(flags):
+    '''convert stored flags text ("IMAP:" + comma-separated IMAP flags,
+    or Maildir info letters) to a FLAG_* bitmask'''
+    if not flags:
+        return 0
+    bits = 0
+    if flags.startswith('IMAP:'):
+        for flag in flags[5:].split(','):
+            bits |= imapFlagBits.get(flag.strip().lower(), 0)
+    else:
+        for letter in flags:
+            bits |= maildirFlagBits.get(letter, 0)
+    return bits
+
+def db_connect(dbfile, cacheKB=65536):
+    '''get connection using write-ahead logging and pragmas tuned for
+    bulk ingest.  Dates are stored as integer UTC epoch seconds, so no
+    type conversion is needed'''
+    conn = sqlite3.connect(dbfile)
+    conn.execute('pragma journal_mode=WAL')
+    conn.execute('pragma synchronous=NORMAL') # safe with WAL
+    conn.execute('pragma temp_store=MEMORY')
+    conn.execute('pragma cache_size=-%d' % cacheKB)
+    return conn
+
+def create_tables(c, myAddrs=()):
+    'create all tables of a new triage db, discarding any old ones'
+    create_messages_table(c)
+    create_addrs_table(c)
+    create_addrs_table(c, 'junkaddrs')
+    create_addrs_table(c, 'verdictaddrs')
+    save_myaddrs_table(c, myAddrs)
+    save_myaddrs_table(c, tableName='notjunk')
+    save_myaddrs_table(c, tableName='vip')
+    save_myaddrs_table(c, tableName='blacklist')
+    create_sender_stats_tables(c)
+    create_syncstate_table(c, clear=True)
+    set_schema_version(c) # tables are already current
 
 def create_messages_table(c, tableName='messages'):
     c.execute('''drop table if exists %s''' % tableName)
@@ -183,13 +369,356 @@ def create_messages_table(c, tableName='messages'):
             date integer,
             flags text,
             received text,
-            sender text,
+            senderID integer,
             fromMe integer,
             subject text,
-            headers text,
-            verdict integer)''' % tableName)
+            headers blob,
+            verdict integer,
+            nsubject text,
+            flagbits integer,
+            fingerprint text)''' % tableName)
     c.execute('create unique index msgid on %s (msgid)' % tableName)
     c.execute('create index threadID on %s (threadID)' % tableName)
+    create_parsed_indexes(c, tableName)
+    create_flag_index(c, tableName)
+    create_fingerprint_index(c, tableName)
+    create_addresses_table(c)
+    c.execute('drop table if exists msgrefs')
+    create_refs_table(c)
+    c.execute('drop table if exists threadforest')
+    create_forest_table(c)
+    c.execute('drop table if exists flag_journal')
+    create_flag_journal_table(c)
+    create_new_index(c, tableName)
+    c.execute('drop table if exists thread_replies')
+    create_replies_table(c, tableName=tableName)
+    c.execute('drop table if exists import_progress') # keys of old rows
+
+def create_replies_table(c, repliesTable='thread_replies',
+                         tableName='messages'):
+    '''date of my last message in each thread, and an index of open
+    (not Closed / Sent) messages by thread and date to check against it'''
+    c.execute('''create table if not exists %s
+            (threadID integer primary key,
+            lastReply integer)''' % repliesTable)
+    c.execute('''create index if not exists open_thread_date on %s
+                 (threadID, date) where mailbox!='Closed' and mailbox!='Sent'
+              ''' % tableName)
+
+def create_flag_index(c, tableName='messages'):
+    'index threads of messages I sent, answered or forwarded'
+    c.execute('''create index if not exists participation on %s (threadID)
+                 where fromMe=1 or flagbits&%d''' % (tableName, FLAG_REPLIED))
+
+def create_new_index(c, tableName='messages'):
+    'index NEW (not yet threaded) messages, so each round finds them directly'
+    c.execute('''create index if not exists new_messages on %s (id)
+                 where myThread='NEW' ''' % tableName)
+
+def create_fingerprint_index(c, tableName='messages'):
+    'index content fingerprints, for finding duplicate copies of a message'
+    c.execute('create index if not exists fingerprint on %s (fingerprint)'
+              % tableName)
+
+def create_parsed_indexes(c, tableName='messages', senderColumn='senderID'):
+    'index the columns parsed from headers at ingest'
+    c.execute('''create index if not exists sender_verdict on %s
+                 (%s, verdict, myThread)''' % (tableName, senderColumn))
+    c.execute('create index if not exists nsubject on %s (nsubject)'
+              % tableName)
+
+def create_refs_table(c, tableName='msgrefs'):
+    'one row per References / In-Reply-To edge (id, referenced msgid)'
+    c.execute('''create table if not exists %s
+            (id integer,
+            ref text,
+            primary key (id, ref))''' % tableName)
+    c.execute('create index if not exists %s_ref on %s (ref)'
+              % (tableName, tableName))
+
+def create_forest_table(c, tableName='threadforest'):
+    'union-find (parent, rank) of message ids; absent ids are own threads'
+    c.execute('''create table if not exists %s
+            (id integer primary key,
+            parent integer,
+            rank integer)''' % tableName)
+
+def create_flag_journal_table(c, tableName='flag_journal'):
+    '''ids of threaded messages whose flags changed since the last
+    threading round, whose threads' myThread must be rechecked'''
+    c.execute('''create table if not exists %s
+            (id integer primary key)''' % tableName)
+
+def get_columns(c, tableName='messages'):
+    c.execute('pragma table_info(%s)' % tableName)
+    return [t[1] for t in c.fetchall()]
+
+def migrate_parsed_headers(c, tableName='messages', refsTable='msgrefs'):
+    '''add nsubject column and refs table to a pre-existing db,
+    backfilling them (and sender) from the JSON headers column'''
+    if 'nsubject' not in get_columns(c, tableName):
+        c.execute('alter table %s add column nsubject text' % tableName)
+    create_refs_table(c, refsTable)
+    create_parsed_indexes(c, tableName, 'sender') # before migrate_address_ids
+    print 'migrating: parsing stored headers...'
+    c.execute('select id,headers from %s where headers is not null'
+              % tableName)
+    rows = []
+    refs = []
+    for uid, headers in c.fetchall():
+        headers = decode_headers(headers)
+        rows.append((get_headers_sender(headers),
+                     normalize_subject(headers.get('subject', None)), uid))
+        refs += [(uid, r) for r in extract_references(headers)]
+    c.executemany('update %s set sender=?,nsubject=? where id=?'
+                  % tableName, rows)
+    c.executemany('insert or ignore into %s values (?,?)' % refsTable, refs)
+
+def migrate_thread_forest(c, tableName='messages',
+                          forestTable='threadforest'):
+    '''build the union-find thread forest of a pre-existing db from its
+    threadID labels: each labelled message points to its thread label.
+    Also indexes NEW messages and adds the flag journal, so that a
+    threading round only reads the messages and threads that changed'''
+    create_refs_table(c) # adds index on ref
+    create_forest_table(c, forestTable)
+    create_new_index(c, tableName)
+    create_flag_journal_table(c)
+    c.execute('''insert or replace into %s
+                 select id, threadID, case when id=threadID then 1 else 0 end
+                 from %s where threadID is not null'''
+              % (forestTable, tableName))
+
+def create_sender_stats_tables(c, tableName='sender_stats',
+                               journalTable='verdict_journal',
+                               scoringTable='sender_scoring'):
+    '''per-sender counters kept up to date by update_sender_stats(),
+    old verdicts of messages whose verdict changed since its last call,
+    and the goodVerdicts and totals used by the last full scoring'''
+    c.execute('''create table if not exists %s
+            (id integer primary key,
+            relevant integer default 0,
+            total integer default 0,
+            kept integer default 0,
+            trashed integer default 0)''' % tableName)
+    c.execute('''create table if not exists %s
+            (id integer primary key,
+            verdict integer)''' % journalTable)
+    c.execute('''create table if not exists %s
+            (goodVerdicts text,
+            nrelevant integer,
+            ntotal integer)''' % scoringTable)
+
+def migrate_sender_verdict_index(c, tableName='messages'):
+    'replace the sender index by a covering (sender, verdict, myThread) one'
+    c.execute('drop index if exists sender')
+    create_parsed_indexes(c, tableName, 'sender') # before migrate_address_ids
+
+def migrate_thread_replies(c):
+    'add the last-reply-per-thread table, and fill it'
+    rebuild_thread_replies(c)
+
+def migrate_flag_bits(c, tableName='messages'):
+    'add flagbits column to a pre-existing db, converting its text flags'
+    if 'flagbits' not in get_columns(c, tableName):
+        c.execute('alter table %s add column flagbits integer' % tableName)
+    create_flag_index(c, tableName)
+    c.execute('select id,flags from %s' % tableName)
+    c.executemany('update %s set flagbits=? where id=?' % tableName,
+                  [(flag_bits(flags), uid) for uid, flags in c.fetchall()])
+
+def migrate_fingerprints(c, tableName='messages'):
+    'add fingerprint column to a pre-existing db, computed from its columns'
+    if 'fingerprint' not in get_columns(c, tableName):
+        c.execute('alter table %s add column fingerprint text' % tableName)
+    create_fingerprint_index(c, tableName)
+    print 'migrating: fingerprinting messages...'
+    c.execute('select id,date,sender,nsubject,msgid from %s' % tableName)
+    c.executemany('update %s set fingerprint=? where id=?' % tableName,
+                  [(message_fingerprint(*t[1:]), t[0])
+                   for t in c.fetchall()])
+
+def get_headers_size(c, tableName='messages'):
+    'get (nrows, nbytes) of the stored headers column'
+    c.execute('select count(headers), total(length(headers)) from %s'
+              % tableName)
+    nrows, nbytes = c.fetchone()
+    return nrows, int(nbytes)
+
+def migrate_compress_headers(c, headerFields=STORED_HEADERS,
+                             tableName='messages', batchSize=10000):
+    '''re-encode JSON text headers of a pre-existing db with
+    encode_headers(), in batches of batchSize rows, then VACUUM
+    to return the freed pages to the filesystem'''
+    nrows, before = get_headers_size(c, tableName)
+    print 'migrating: compressing %d stored headers...' % nrows
+    lastID = 0
+    while True:
+        c.execute('''select id,headers from %s where id>? and
+                     typeof(headers)='text' order by id limit ?'''
+                  % tableName, (lastID, batchSize))
+        rows = c.fetchall()
+        if not rows:
+            break
+        c.executemany('update %s set headers=? where id=?' % tableName,
+                      [(sqlite3.Binary(encode_headers(json.loads(headers),
+                                                      headerFields)),
+                        uid) for uid, headers in rows])
+        lastID = rows[-1][0]
+    after = get_headers_size(c, tableName)[1]
+    print 'headers: %d bytes -> %d bytes (%.0f%% saved)' \
+          % (before, after, 100. * (before - after) / max(before, 1))
+    c.execute('vacuum') # commits first
+
+def rekey_email_table(c, tableName, create_f, addrTable='addresses'):
+    '''replace the email text key of a pre-existing table by the address
+    id, recreating it with create_f(c, tableName)'''
+    if 'email' not in get_columns(c, tableName):
+        return
+    c.execute('drop table if exists %s_old' % tableName)
+    c.execute('alter table %s rename to %s_old' % (tableName, tableName))
+    create_f(c, tableName)
+    columns = get_columns(c, tableName)[1:]
+    c.execute('''insert or ignore into %s (email) select lower(email)
+                 from %s_old where email is not null'''
+              % (addrTable, tableName))
+    c.execute('''insert or ignore into %s select %s from %s_old o, %s a
+                 where a.email=lower(o.email)'''
+              % (tableName, ', '.join(['a.id'] + ['o.' + k for k in columns]),
+                 tableName, addrTable))
+    c.execute('drop table %s_old' % tableName)
+
+def migrate_address_ids(c, tableName='messages'):
+    '''intern the sender addresses of a pre-existing db: messages get a
+    senderID column (freeing their sender text), and all email-keyed
+    tables are rekeyed by address id'''
+    create_addresses_table(c)
+    if 'senderID' not in get_columns(c, tableName):
+        c.execute('alter table %s add column senderID integer' % tableName)
+    print 'migrating: interning sender addresses...'
+    c.execute('''insert or ignore into addresses (email) select distinct
+                 sender from %s where sender is not null and sender != ""'''
+              % tableName)
+    c.execute('''update %s set senderID=(select id from addresses a
+                 where a.email=%s.sender), sender=NULL
+                 where sender is not null and sender != ""'''
+              % (tableName, tableName))
+    c.execute('drop index if exists sender_verdict')
+    create_parsed_indexes(c, tableName)
+    for name in ('addrs', 'junkaddrs', 'verdictaddrs'):
+        rekey_email_table(c, name, create_addrs_table)
+    for name in ('myaddrs', 'notjunk', 'vip', 'blacklist'):
+        rekey_email_table(c, name,
+                          lambda c, name: save_myaddrs_table(c, (), name))
+    rekey_email_table(c, 'sender_stats',
+                      lambda c, name: create_sender_stats_tables(c, name))
+
+def migrate_epoch_dates(c, tableName='messages', repliesTable='thread_replies',
+                        addrTable='addresses'):
+    '''convert the datetime text of a pre-existing db to integer UTC
+    epoch seconds, recomputing the fingerprints that include them'''
+    print 'migrating: converting dates to epoch seconds...'
+    for table, column in ((tableName, 'date'), (repliesTable, 'lastReply')):
+        c.execute('''update %s set %s=cast(strftime('%%s', %s) as integer)
+                     where typeof(%s)='text' ''' % (table, column, column,
+                                                   column))
+    c.execute('''select m.id, m.date, a.email, m.nsubject, m.msgid
+                 from %s m left join %s a on a.id=m.senderID'''
+              % (tableName, addrTable))
+    c.executemany('update %s set fingerprint=? where id=?' % tableName,
+                  [(message_fingerprint(*t[1:]), t[0])
+                   for t in c.fetchall()])
+
+def migrate_utc_dates(c, defaultTZ=7*3600, tableName='messages',
+                      addrTable='addresses', batchSize=10000):
+    '''re-parse the stored Date header of each message, in batches of
+    batchSize rows, fixing dates saved with a +0000 zone treated as
+    no zone (i.e. shifted by defaultTZ), and their fingerprints'''
+    print 'migrating: correcting UTC dates...'
+    lastID = 0
+    while True:
+        c.execute('''select m.id, m.date, m.headers, a.email, m.nsubject,
+                     m.msgid from %s m left join %s a on a.id=m.senderID
+                     where m.id>? and m.headers is not null
+                     order by m.id limit ?''' % (tableName, addrTable),
+                  (lastID, batchSize))
+        rows = c.fetchall()
+        if not rows:
+            break
+        updates = []
+        for uid, date, headers, sender, nsubject, msgID in rows:
+            try:
+                newDate = parse_date(decode_headers(headers)['date'],
+                                     defaultTZ)
+            except (TypeError, KeyError): # no Date header
+                continue
+            if newDate is not None and newDate != date:
+                updates.append((newDate, message_fingerprint(newDate, sender,
+                                                             nsubject, msgID),
+                                uid))
+        c.executemany('update %s set date=?, fingerprint=? where id=?'
+                      % tableName, updates)
+        lastID = rows[-1][0]
+    rebuild_thread_replies(c, tableName)
+
+def create_syncstate_table(c, tableName='syncstate', clear=False):
+    '''UID sync state for each (serverID, mailbox).  clear=True discards
+    any saved state, which is only valid for the old messages table'''
+    if clear:
+        c.execute('drop table if exists %s' % tableName)
+    c.execute('''create table if not exists %s
+            (serverID integer,
+            mailbox text,
+            uidvalidity integer,
+            lastuid integer,
+            modseq integer,
+            primary key (serverID, mailbox))''' % tableName)
+
+MIGRATIONS = (create_syncstate_table, # in order; never reorder or remove
+              migrate_parsed_headers,
+              migrate_thread_forest,
+              create_sender_stats_tables, # filled by first update_threads()
+              migrate_sender_verdict_index,
+              migrate_thread_replies,
+              migrate_flag_bits,
+              migrate_fingerprints,
+              migrate_compress_headers,
+              migrate_address_ids,
+              migrate_epoch_dates,
+              migrate_utc_dates)
+
+def set_schema_version(c, version=len(MIGRATIONS)):
+    c.execute('pragma user_version=%d' % version)
+
+def migrate_db(c):
+    'apply any MIGRATIONS not yet recorded in the db user_version'
+    c.execute('pragma user_version')
+    version = c.fetchone()[0]
+    for i, f in enumerate(MIGRATIONS[version:]):
+        f(c)
+        set_schema_version(c, version + i + 1)
+
+def get_sync_state(c, mailbox, serverID=1, tableName='syncstate'):
+    c.execute('select uidvalidity, lastuid, modseq from %s where serverID=? and mailbox=?'
+              % tableName, (serverID, mailbox))
+    return c.fetchone()
+
+def save_sync_state(c, mailbox, state, serverID=1, tableName='syncstate'):
+    c.execute('insert or replace into %s values (?,?,?,?,?)' % tableName,
+              (serverID, mailbox) + tuple(state))
+
+def save_flags(c, flagChanges, mailbox, serverID=1, tableName='messages',
+               journalTable='flag_journal'):
+    '''update stored IMAP flags for {serverMsg:imapFlags}, journaling
+    threaded messages whose flag bits changed for thread_new_messages()'''
+    for serverMsg, imapFlags in flagChanges.items():
+        flags = 'IMAP:' + ','.join(imapFlags)
+        bits = flag_bits(flags)
+        c.execute('insert or ignore into %s select id from %s where serverID=? and mailbox=? and serverMsg=? and threadID is not null and flagbits is not ?'
+                  % (journalTable, tableName),
+                  (serverID, mailbox, serverMsg, bits))
+        c.execute('update %s set flags=?,flagbits=? where serverID=? and mailbox=? and serverMsg=?'
+                  % tableName, (flags, bits, serverID, mailbox, serverMsg))
 
 def create_threads_table(c):
     c.execute('''drop table if exists threads''')
@@ -204,38 +733,49 @@ def save_threads(c, msgThread):
 def create_addrs_table(c, name='addrs'):
     c.execute('drop table if exists %s' % name)
     c.execute('''create table %s
-            (email text primary key, 
+            (id integer primary key, 
             pval real,
             nrelevant integer,
             ntotal integer)''' % name)
 
-def save_addrs(c, scores, tableName='addrs'):
+def save_addrs(c, scores, tableName='addrs', replace=False):
+    if replace: # update existing rows
+        sql = 'insert or replace into %s values (?,?,?,?)'
+    else:
+        sql = 'insert into %s values (?,?,?,?)'
     for p,m,n,a in scores:
-        c.execute('insert into %s values (?,?,?,?)' % tableName, (a,p,m,n))
+        c.execute(sql % tableName, (a,p,m,n))
 
 def save_myaddrs_table(c, myAddrs=(), tableName='myaddrs'):
+    'add email addresses myAddrs to tableName, by address id'
     c.execute('''create table if not exists %s
-            (email text primary key)''' % tableName)
-    for a in myAddrs:
-        c.execute('insert or ignore into %s values (?)' % tableName, (a,))
+            (id integer primary key)''' % tableName)
+    addrIDs = get_address_ids(c, [a.lower() for a in myAddrs], True)
+    c.executemany('insert or ignore into %s values (?)' % tableName,
+                  [(i,) for i in addrIDs.values()])
+
+def get_myaddrs(c, tableName='myaddrs', addrTable='addresses'):
+    'get set of email addresses in tableName'
+    c.execute('select a.email from %s m, %s a where a.id=m.id'
+              % (tableName, addrTable))
+    return set([t[0] for t in c.fetchall()])
 
 def get_all_recipients(m):
+    'get frozenset of lowercase recipient addresses of m'
     tos = m.get_all('to', [])
     ccs = m.get_all('cc', [])
     resent_tos = m.get_all('resent-to', [])
     resent_ccs = m.get_all('resent-cc', [])
-    return email.utils.getaddresses(tos + ccs + resent_tos + resent_ccs)
+    return parse_addresses(tos + ccs + resent_tos + resent_ccs)
 
 def is_from_me(m, myAddrs):
     'assess whether message is from me or not'
-    origin = email.utils.getaddresses(m.get_all('from', []))
-    origin = frozenset([t[1].lower() for t in origin])
+    origin = parse_addresses(m.get_all('from', []))
     if not origin.isdisjoint(myAddrs):
         return True # sent by me
     else:
         received = m.get('received', None)
         recipients = get_all_recipients(m)
-        recipients = frozenset([t[1].lower() for t in recipients])
         if received or not recipients.isdisjoint(myAddrs):
             return False # sent to me
         else:
@@ -253,10 +793,7 @@ def save_sqlite3(mailboxes, myAddrs=None, dbfile='maildir.db',
         save_myaddrs_table(c, myAddrs)
         conn.commit()
     else: # read from database
-        myAddrs = set()
-        c.execute('select * from myaddrs')
-        for t in c.fetchall():
-            myAddrs.add(t[0].lower())
+        myAddrs = get_myaddrs(c)
             
     for md in mailboxes:
         mboxName = os.path.basename(md._path)
@@ -266,130 +803,504 @@ def save_sqlite3(mailboxes, myAddrs=None, dbfile='maildir.db',
         conn.commit()
     c.close()
 
+class MaildirHeaders(email.message.Message):
+    'headers of a Maildir message file, with the flags of its filename info'
+    def __init__(self):
+        email.message.Message.__init__(self)
+        self._flags = ''
+    def get_flags(self):
+        return self._flags
+
+def read_header_text(path, blocksize=8192):
+    'read a message file only up to the blank line ending its header'
+    with open(path, 'rb') as ifile:
+        text = ''
+        while True:
+            block = ifile.read(blocksize)
+            text += block
+            m = re.search(r'\r?\n\r?\n', text)
+            if m:
+                return text[:m.end()]
+            if not block: # no body
+                return text
+
+def list_maildir_files(path, colon=':'):
+    '''get [(key, path, flags),] of the messages of Maildir folder path,
+    where key is the filename without its info suffix, as mailbox.Maildir'''
+    files = []
+    for subdir in ('new', 'cur'):
+        dirpath = os.path.join(path, subdir)
+        for fname in os.listdir(dirpath):
+            if fname[0] == '.':
+                continue
+            key, sep, info = fname.partition(colon)
+            if info.startswith('2,'):
+                flags = info[2:]
+            else:
+                flags = ''
+            files.append((key, os.path.join(dirpath, fname), flags))
+    return files
+
+_importArgs = {}
+
+def _init_import_worker(myAddrs, defaultTZ, headerFields):
+    'save arguments of parse_maildir_file() in each pool process'
+    _importArgs.update(myAddrs=myAddrs, defaultTZ=defaultTZ,
+                       headerFields=headerFields)
+
+def parse_maildir_file(task):
+    '''read and parse the header of one message file, returning
+    (mboxName, key, (row, references)), or row=None if it has no headers'''
+    mboxName, key, path, flags = task
+    m = email.parser.Parser(MaildirHeaders).parsestr(read_header_text(path),
+                                                     headersonly=True)
+    m._flags = flags
+    if len(m) == 0: # no headers??
+        return mboxName, key, None
+    return mboxName, key, message_row(m, key, _importArgs['defaultTZ'],
+                                      is_from_me(m, _importArgs['myAddrs']),
+                                      mboxName,
+                                      headerFields=_importArgs['headerFields'])
+
+def create_import_progress_table(c, tableName='import_progress'):
+    'keys of Maildir files already imported, for resuming bulk imports'
+    c.execute('''create table if not exists %s
+            (mailbox text, key text,
+            primary key (mailbox, key))''' % tableName)
+
+def import_maildirs(mailDir, myAddrs=None, dbfile='maildir.db', nproc=None,
+                    batchSize=5000, chunksize=200, defaultTZ=7*3600,
+                    tableName='messages', refsTable='msgrefs',
+                    progressTable='import_progress',
+                    headerFields=STORED_HEADERS):
+    '''bulk import of all Maildir folders in mailDir, much faster than
+    save_sqlite3(iter_mailboxes(mailDir)).  Only the header block of each
+    file is read, and headers are parsed by a pool of nproc processes
+    (default: one per core; nproc=1 parses in this process), while this
+    process saves their rows in batches of batchSize.  Each batch commits
+    together with the keys of its files, so re-running an interrupted
+    import skips the files already saved.  Messages are saved as NEW;
+    run TriageDB.rebuild_threads() afterwards to thread them'''
+    import multiprocessing
+    conn = db_connect(dbfile)
+    c = conn.cursor()
+    if not get_columns(c, tableName): # new db
+        create_tables(c, myAddrs or ())
+    else: # bring a pre-existing db up to date, as TriageDB() does
+        migrate_db(c)
+        save_myaddrs_table(c, myAddrs or ())
+    create_import_progress_table(c, progressTable)
+    conn.commit()
+    myAddrs = get_myaddrs(c)
+    tasks = []
+    for fname in sorted(os.listdir(mailDir)):
+        path = os.path.join(mailDir, fname)
+        if fname[0] != '.' or not os.path.isdir(path):
+            continue
+        mboxName = os.path.basename(path)
+        c.execute('select key from %s where mailbox=?' % progressTable,
+                  (mboxName,))
+        done = frozenset([t[0] for t in c.fetchall()])
+        files = [(mboxName, key, filepath, flags) for key, filepath, flags
+                 in list_maildir_files(path) if key not in done]
+        print 'importing %d of %d messages: %s' \
+              % (len(files), len(files) + len(done), mboxName)
+        tasks += files
+    initargs = (frozenset(myAddrs), defaultTZ, headerFields)
+    if nproc == 1:
+        from itertools import imap
+        _init_import_worker(*initargs)
+        pool = None
+        results = imap(parse_maildir_file, tasks)
+    else:
+        pool = multiprocessing.Pool(nproc, _init_import_worker, initargs)
+        results = pool.imap(parse_maildir_file, tasks, chunksize)
+    progressSQL = 'insert or ignore into %s values (?,?)' % progressTable
+    nsaved = 0
+    try:
+        keys = []
+        parsed = []
+        for mboxName, key, t in results:
+            keys.append((mboxName, key))
+            if t:
+                parsed.append(t)
+            if len(keys) >= batchSize:
+                save_message_rows(c, parsed, tableName, refsTable)
+                c.executemany(progressSQL, keys)
+                conn.commit() # checkpoint
+                nsaved += len(keys)
+                print '%d / %d messages...' % (nsaved, len(tasks))
+                keys = []
+                parsed = []
+        if keys:
+            save_message_rows(c, parsed, tableName, refsTable)
+            c.executemany(progressSQL, keys)
+            conn.commit()
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+        c.close()
+        conn.close()
+
+def message_fingerprint(date, sender, nsubject, msgID):
+    '''hash of the normalized date, sender and subject, plus Message-ID
+    when present: copies of the same message get the same fingerprint.
+    None if it has neither date nor Message-ID, since repeated mails
+    (e.g. notifications) from one sender would all look the same'''
+    if date is None and not msgID:
+        return None
+    l = []
+    for v in (date, sender, nsubject, msgID):
+        if isinstance(v, str): # as stored by sqlite
+            v = v.decode('utf-8', 'replace')
+        l.append(unicode(v or ''))
+    return hashlib.sha1('\0'.join(l).encode('utf-8')).hexdigest()
+
+_dateCache = LRUCache(10000) # {(Date header, defaultTZ):epoch seconds}
+
+RFC2822_DATE = re.compile(r'\s*(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})'
+                          r'\s+(\d{4})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?'
+                          r'\s+([+-])(\d{2})(\d{2})\s*(?:\(.*\))?\s*$')
+MONTHS = dict([(m, i + 1) for i, m in
+               enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                          'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))])
+
+def parse_date(s, defaultTZ=7*3600, cache=_dateCache):
+    '''convert Date header s to UTC epoch seconds, or None if invalid.
+    The usual numeric-zone format is parsed directly; anything else by
+    email.utils.parsedate_tz().  defaultTZ is seconds west of UTC, for
+    dates without a zone'''
+    try:
+        return cache[(s, defaultTZ)]
+    except KeyError:
+        pass
+    match = RFC2822_DATE.match(s)
+    if match and match.group(2).lower() in MONTHS:
+        day, month, year, hour, minute, second, sign, tzh, tzm = \
+             match.groups()
+        t = (int(year), MONTHS[month.lower()], int(day), int(hour),
+             int(minute), int(second or 0))
+        tz = (int(tzh) * 3600 + int(tzm) * 60) * (sign == '-' and -1 or 1)
+    else:
+        t = email.utils.parsedate_tz(s)
+        if not t:
+            return None
+        tz = t[9]
+    try:
+        u = calendar.timegm(t[:6])
+    except (ValueError, OverflowError):
+        return None
+    if tz is None: # no zone, unlike an explicit +0000
+        u += defaultTZ
+    else:
+        u -= tz
+    cache[(s, defaultTZ)] = u
+    return u
+
+MESSAGE_ROW_COLUMNS = ('msgid', 'serverID', 'serverMsg', 'mailbox', 'date',
+                       'flags', 'received', 'senderID', 'fromMe', 'subject',
+                       'headers', 'verdict', 'nsubject', 'flagbits',
+                       'fingerprint')
+
+def message_row(m, serverMsg, defaultTZ=7*3600, fromMe=None, mboxName=None,
+                serverID=0, verdict=None, headerFields=STORED_HEADERS):
+    '''get tuple of values of MESSAGE_ROW_COLUMNS for saving message m,
+    storing only its headerFields (all, if None) in the headers blob.
+    Its senderID is still the address, and headers are raw compressed
+    bytes; save_message_rows() converts both for storing'''
+    try:
+        date = parse_date(m['date'], defaultTZ)
+    except (TypeError,KeyError): # no Date header
+        date = None
+    try:
+        flags = m.get_flags()
+    except AttributeError:
+        try:
+            imapFlags = m._imapFlags
+        except AttributeError:
+            flags = None
+        else:
+            flags = 'IMAP:' + ','.join(imapFlags)
+    d = {}
+    for k,v in m.items():
+        try:
+            d[k.lower()] = unicode(v)
+        except UnicodeDecodeError:
+            d[k.lower()] = 'unknown encoding'
+    headers = encode_headers(d, headerFields)
+    sender = get_headers_sender(d)
+    nsubject = normalize_subject(d.get('subject', None))
+    row = (m['message-id'], serverID, serverMsg, 
+           mboxName, date, flags,
+           d.get('received', None), sender,
+           fromMe, d.get('subject', None), headers, verdict,
+           nsubject, flag_bits(flags),
+           message_fingerprint(date, sender, nsubject, m['message-id']))
+    return row, extract_references(d)
+
 def save_messages(c, messages, defaultTZ=7*3600, from_me_f=is_from_me, 
                   fromMe=None, myAddrs=None, mboxName=None, serverID=0,
-                  verdict=None, tableName='messages'):
+                  verdict=None, tableName='messages', refsTable='msgrefs',
+                  headerFields=STORED_HEADERS):
+    '''save messages as NEW rows using one executemany(), then look up
+    their ids (saved as m.uid) via a temp table of their message-ids.
+    Their References / In-Reply-To edges are saved to refsTable.
+    Only headerFields (all, if None) are kept in the headers blob.
+    Senders are saved as ids of the addresses table'''
+    parsed = []
     for serverMsg,m in messages:
         if len(m) == 0: # no headers??
             continue
         if callable(from_me_f):
             fromMe = from_me_f(m, myAddrs)
         m.fromMe = fromMe # save flag on message object
-        try:
-            t = email.utils.parsedate_tz(m['date'])
-            if not t:
-                raise KeyError
-            u = time.mktime(t[:9])
-            if t[9]:
-                date = datetime.datetime.fromtimestamp(u - t[9])
-            else:
-                date = datetime.datetime.fromtimestamp(u + defaultTZ)
-        except (ValueError,KeyError):
-            date = None
-        try:
-            flags = m.get_flags()
-        except AttributeError:
-            try:
-                imapFlags = m._imapFlags
-            except AttributeError:
-                flags = None
-            else:
-                flags = 'IMAP:' + ','.join(imapFlags)
-        d = {}
-        for k,v in m.items():
-            try:
-                d[k.lower()] = unicode(v)
-            except UnicodeDecodeError:
-                d[k.lower()] = 'unknown encoding'
-        headers = json.dumps(d)
-        try:
-            c.execute('insert or ignore into %s values (NULL,?,?,?,NULL,"NEW",?,?,?,?,?,?,?,?,?)'
-                      % tableName,
-                      (m['message-id'], serverID, serverMsg, 
-                       mboxName, date, flags,
-                       d.get('received', None), get_headers_sender(d),
-                       fromMe, d.get('subject', None), headers, verdict))
-            m.uid = c.lastrowid # save unique id
-        except sqlite3.IntegrityError:
-            pass
+        parsed.append((m, message_row(m, serverMsg, defaultTZ, fromMe,
+                                      mboxName, serverID, verdict,
+                                      headerFields)))
+    uids = save_message_rows(c, [t[1] for t in parsed], tableName, refsTable)
+    for (m, t), uid in zip(parsed, uids):
+        m.uid = uid # save unique id
+
+def save_message_rows(c, parsed, tableName='messages', refsTable='msgrefs'):
+    '''save [(row, references),] from message_row() as NEW rows, converting
+    their sender addresses to ids.  Returns their ids (None if ignored).
+    Like a repeated message-id, a message without one is ignored if
+    its fingerprint matches a saved one (see get_fingerprint_uid())'''
+    sql = "insert or ignore into %s (myThread, %s) values ('NEW', %s)" \
+          % (tableName, ', '.join(MESSAGE_ROW_COLUMNS),
+             ','.join('?' * len(MESSAGE_ROW_COLUMNS)))
+    iMsgID, iSender, iHeaders, iFingerprint = \
+            [MESSAGE_ROW_COLUMNS.index(col) for col in
+             ('msgid', 'senderID', 'headers', 'fingerprint')]
+    senderIDs = get_address_ids(c, set([row[iSender] for row, references
+                                        in parsed if row[iSender]]), True)
+    uids = [None] * len(parsed)
+    rows = []
+    refs = []
+    for i, (row, references) in enumerate(parsed):
+        row = list(row)
+        row[iSender] = senderIDs.get(row[iSender], None)
+        if row[iHeaders] is not None:
+            row[iHeaders] = sqlite3.Binary(row[iHeaders])
+        if row[iMsgID] is None: # no message-id, so insert individually
+            uids[i] = get_fingerprint_uid(c, row[iFingerprint], tableName)
+            if uids[i] is None:
+                c.execute(sql, row)
+                uids[i] = c.lastrowid
+            refs += [(uids[i], r) for r in references]
+        else:
+            rows.append((i, row))
+    if rows:
+        c.executemany(sql, [row for i, row in rows])
+        uidDict = get_msgid_uids(c, [row[iMsgID] for i, row in rows],
+                                 tableName)
+        for i, row in rows:
+            uids[i] = uidDict.get(row[iMsgID], None)
+            refs += [(uids[i], r) for r in parsed[i][1]]
+    c.executemany('insert or ignore into %s values (?,?)' % refsTable, refs)
+    return uids
+
+def _temp_table(c, name, cols):
+    '''get an empty temp table name with column definitions cols.
+    Reuses an existing one, since DDL commits any open transaction'''
+    c.execute('select name from sqlite_temp_master where name=?', (name,))
+    if c.fetchone():
+        c.execute('delete from %s' % name)
+    else:
+        c.execute('create temp table %s (%s)' % (name, cols))
+
+def update_from_temp(c, tableName, tmpTable, columns, extra='', params=(),
+                     where=None):
+    '''copy columns from tmpTable (aliased t) to the rows of tableName
+    with the same id, also applying assignments extra (with params).
+    where optionally limits the update to rows where it holds.
+    Uses UPDATE ... FROM if supported (sqlite 3.33+)'''
+    if sqlite3.sqlite_version_info >= (3, 33, 0):
+        sets = ['%s=t.%s' % (col, col) for col in columns]
+        cond = '%s.id=t.id' % tableName
+        sql = 'update %s set %%s from %s t where %%s' % (tableName, tmpTable)
+    else: # correlated subqueries instead
+        sets = ['%s=(select %s from %s t where t.id=%s.id)'
+                % (col, col, tmpTable, tableName) for col in columns]
+        cond = 't.id=%s.id' % tableName
+        sql = 'update %s set %%s where id in (select t.id from %s t where %%s)' \
+              % (tableName, tmpTable)
+    if extra:
+        sets.append(extra)
+    if where:
+        cond += ' and (%s)' % where
+    c.execute(sql % (', '.join(sets), cond), params)
+
+def get_fingerprint_uid(c, fingerprint, tableName='messages'):
+    '''get id of the saved message without message-id with this
+    fingerprint, or None (always, if fingerprint is None)'''
+    if fingerprint is None:
+        return None
+    c.execute('''select min(id) from %s
+                 where fingerprint=? and msgid is null''' % tableName,
+              (fingerprint,))
+    return c.fetchone()[0]
+
+def stage_msgids(c, rows, tmpTable='msgid_tmp'):
+    'load [(msgid, serverMsg),] into a temp table for set-based queries'
+    _temp_table(c, tmpTable, 'msgid text primary key, serverMsg text')
+    c.executemany('insert or replace into %s values (?,?)' % tmpTable, rows)
+
+def stage_ids(c, ids, tmpTable='id_tmp'):
+    'load message ids into a temp table for set-based queries'
+    _temp_table(c, tmpTable, 'id integer primary key')
+    c.executemany('insert or ignore into %s values (?)' % tmpTable,
+                  [(uid,) for uid in ids])
+
+def get_msgid_uids(c, msgIDs, tableName='messages', tmpTable='msgid_tmp'):
+    'get {msgid:id} for the specified message-ids in one query'
+    stage_msgids(c, [(msgID, None) for msgID in msgIDs], tmpTable)
+    c.execute('select m.msgid, m.id from %s m, %s t where m.msgid=t.msgid'
+              % (tableName, tmpTable))
+    return dict(c.fetchall())
 
 def save_verdicts(c, messages, mboxName, verdict, overwrite=True,
-                  tableName='messages', **kwargs):
-    'record user triage decision of messages'
+                  tableName='messages', tmpTable='verdict_tmp',
+                  journalTable='verdict_journal', **kwargs):
+    '''record user triage decision of messages, as a single UPDATE
+    against a temp table of their ids, found by message-id or, lacking
+    one, by fingerprint (or, lacking that too, by server message id).
+    Old verdicts of threaded messages are journaled for
+    update_sender_stats()'''
+    msgDict = {}
+    newMsgs = []
+    found = []
     for serverMsg,m in messages:
-        try:
-            msgID = m['message-id']
-        except KeyError:
-            continue
-        if overwrite: # overwrite old verdict
-            c.execute('update %s set serverMsg=?, mailbox=?, verdict=? where msgid=?' % tableName, 
-                      (serverMsg, mboxName, verdict, msgID))
-        else: # save verdict iff not yet set
-            c.execute('update %s set serverMsg=?, mailbox=?, verdict=? where msgid=? and verdict is NULL' % tableName,
-                      (serverMsg, mboxName, verdict, msgID))
-            if c.rowcount == 0: # preserve old verdict
-                c.execute('update %s set serverMsg=?, mailbox=? where msgid=?' % tableName, 
-                          (serverMsg, mboxName, msgID))
-        if c.rowcount == 0: # message not found in database, so insert NEW
-            save_messages(c, [(serverMsg,m)], mboxName=mboxName,
-                          verdict=verdict, tableName=tableName, **kwargs)
-        elif c.rowcount > 1:
-            warnings.warn('save_verdict: message-id %s not unique, rowcount %d'
-                          % (msgID, c.rowcount))
+        msgID = m['message-id']
+        if msgID is None: # match to database by fingerprint
+            fingerprint = message_row(m, serverMsg)[0][
+                MESSAGE_ROW_COLUMNS.index('fingerprint')]
+            uid = get_fingerprint_uid(c, fingerprint, tableName)
+            if fingerprint is None: # only known by where we last saw it
+                c.execute('select min(id) from %s where serverID=? and mailbox=? and serverMsg=?'
+                          % tableName, (kwargs.get('serverID', 0), mboxName,
+                                        serverMsg))
+                uid = c.fetchone()[0]
+            if uid is None:
+                newMsgs.append((serverMsg, m))
+            else:
+                found.append((uid, serverMsg))
+        else:
+            msgDict[msgID] = (serverMsg, m)
+    stage_msgids(c, [(msgID, t[0]) for msgID,t in msgDict.items()])
+    c.execute('select msgid from msgid_tmp t where not exists (select 1 from %s m where m.msgid=t.msgid)'
+              % tableName)
+    for t in c.fetchall(): # message not found in database, so insert NEW
+        newMsgs.append(msgDict[t[0]])
+    _temp_table(c, tmpTable, 'id integer primary key, serverMsg text')
+    c.execute('insert into %s select m.id, t.serverMsg from %s m, msgid_tmp t where m.msgid=t.msgid'
+              % (tmpTable, tableName))
+    c.executemany('insert or replace into %s values (?,?)' % tmpTable, found)
+    if overwrite: # overwrite old verdict
+        newVerdict = '?'
+        c.execute("insert or ignore into %s select m.id, m.verdict from %s m, %s t where m.id=t.id and m.myThread is not 'NEW' and m.verdict is not ?"
+                  % (journalTable, tableName, tmpTable), (verdict,))
+    else: # save verdict iff not yet set, otherwise preserve old verdict
+        newVerdict = 'coalesce(verdict, ?)'
+        c.execute("insert or ignore into %s select m.id, m.verdict from %s m, %s t where m.id=t.id and m.myThread is not 'NEW' and m.verdict is null"
+                  % (journalTable, tableName, tmpTable))
+    update_from_temp(c, tableName, tmpTable, ('serverMsg',),
+                     'mailbox=?, verdict=%s' % newVerdict, (mboxName, verdict))
+    if newMsgs:
+        save_messages(c, newMsgs, mboxName=mboxName,
+                      verdict=verdict, tableName=tableName, **kwargs)
 
 
 def get_my_message_ids(c):
     c.execute('select id from messages where fromMe=1')
     return frozenset([t[0] for t in c.fetchall()])
 
+def normalize_subject(subject):
+    'remove initial RE: from subject; None if nothing else left'
+    if not subject:
+        return None
+    l = subject.split()
+    for i,w in enumerate(l):
+        if w.lower() != 're:':
+            return ' '.join(l[i:])
+
 def get_subjects(c):
     d = {}
-    c.execute('''select id,date as "[timestamp]",subject from messages 
-                 where subject is not null and date is not null''')
+    c.execute('''select id,date,nsubject from messages 
+                 where nsubject is not null and date is not null''')
     for uid, msgDate, subject in c.fetchall():
-        l = subject.split()
-        subject = ''
-        for i,w in enumerate(l): # remove initial RE: from subject
-            if w.lower() != 're:':
-                subject = ' '.join(l[i:])
-                break
-        if subject:
-            d.setdefault(subject, []).append((uid, msgDate))
+        d.setdefault(subject, []).append((uid, msgDate))
     return d
 
-def get_rank(l, v):
-    left = 0
-    right = len(l)
-    while right - left > 1:
-        mid = (left + right) / 2
-        if l[mid] < v:
-            left = mid
-        else:
-            right = mid
-    return right
+def subject_arrays(subjectDict, msgThread=None):
+    '''flatten {subject:[(uid, epochSeconds),]} into arrays sorted by subject,
+    then date and uid: (subjects, subjectIndex, uids, times, threads).
+    If msgThread is given, only keep messages with a known thread.
+    Subjects with fewer than two such messages are skipped'''
+    subjects = []
+    sidx = []
+    uids = []
+    dates = []
+    for subject, messages in subjectDict.items():
+        if msgThread is not None:
+            messages = [t for t in messages if t[0] in msgThread]
+        if len(messages) < 2:
+            continue
+        sidx += [len(subjects)] * len(messages)
+        subjects.append(subject)
+        for uid, msgDate in messages:
+            uids.append(uid)
+            dates.append(msgDate)
+    uids = numpy.array(uids, dtype=numpy.int64)
+    times = numpy.array(dates, dtype=float)
+    sidx = numpy.array(sidx, dtype=numpy.int64)
+    order = numpy.lexsort((uids, times, sidx))
+    uids = uids[order]
+    if msgThread is not None:
+        threads = numpy.array([msgThread[uid] for uid in uids.tolist()],
+                              dtype=numpy.int64)
+    else:
+        threads = None
+    return subjects, sidx[order], uids, times[order], threads
+
+def segment_starts(keys):
+    'start index of each run of equal values in sorted array keys'
+    if not len(keys):
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
 
 def subject_unreliability(subjectDict, threadTimes, subjectP=0.004, linkP=0.2):
+    '''score the time gap between consecutive messages with the same
+    subject against threadTimes (sorted seconds, from threadtime_roc()),
+    and combine each subject's link p-values with jost_pvalues().
+    Returns [(p, subject),] sorted, and {subject:[(p, uid, uid2),]}'''
+    threadTimes = numpy.asarray(threadTimes, dtype=float)
     n = float(len(threadTimes))
-    l = []
+    subjects, sidx, uids, times, threads = subject_arrays(subjectDict)
+    same = sidx[1:] == sidx[:-1] # consecutive messages, same subject
+    linkSubject = sidx[:-1][same]
+    uid1 = uids[:-1][same].tolist()
+    uid2 = uids[1:][same].tolist()
+    timediff = (times[1:] - times[:-1])[same]
+    rank = numpy.maximum(numpy.searchsorted(threadTimes, timediff), 1)
+    pvals = (n + 1 - rank) / n
+    starts = segment_starts(linkSubject)
+    subjectPvals = jost_pvalues(pvals, starts)
+    counts = numpy.diff(numpy.r_[starts, len(pvals)])
+    unreliable = (subjectPvals < subjectP) & (counts > 1)
+    keep = ~numpy.repeat(unreliable, counts) | (pvals > linkP) # filter links
+    l = zip(subjectPvals.tolist(), subjects)
+    l.sort()
+    pvals = pvals.tolist()
     d = {}
-    for subject, messages in subjectDict.items():
-        if len(messages) < 2:
-            continue
-        logP = 0.
-        messages = [(t[1],t[0]) for t in messages]
-        messages.sort()
-        vals = []
-        for i, msg1 in enumerate(messages[:-1]):
-            timediff = messages[i + 1][0] - msg1[0]
-            p = (n + 1 - get_rank(threadTimes, timediff)) / n
-            vals.append((p, msg1[1], messages[i + 1][1]))
-        p = jost_pvalue([t[0] for t in vals])
-        l.append((p, subject))
-        if p < subjectP and len(vals) > 1: # filter unreliable links
-            vals = [t for t in vals if t[0] > linkP]
+    for i, subject in enumerate(subjects):
+        vals = [(pvals[j], uid1[j], uid2[j]) 
+                for j in xrange(starts[i], starts[i] + counts[i]) if keep[j]]
         if vals:
             d[subject] = vals
-    l.sort()
     return l, d
 
 def link_fusions(msgGraph, subjectFusions):
@@ -400,58 +1311,64 @@ def link_fusions(msgGraph, subjectFusions):
             
 
 def threadtime_roc(c, msgThread):
-    c.execute('''select id,date as "[timestamp]" from messages
-                 where date is not null''')
-    d = {}
-    for uid, msgDate in c.fetchall():
-        try:
-            threadID = msgThread[uid]
-        except KeyError:
-            continue
-        d.setdefault(threadID, []).append(msgDate)
-    roc = []
-    for dates in d.values():
-        dates.sort() # in ascending temporal order
-        for date1 in dates[:-1]:
-            roc.append(dates[-1] - date1)
+    '''get sorted array of seconds from each message to the last message
+    of its thread'''
+    c.execute('select id,date from messages where date is not null')
+    rows = [(msgThread[uid], t) for uid, t in c.fetchall() if uid in msgThread]
+    if not rows:
+        return numpy.zeros(0)
+    threads, times = numpy.array(rows, dtype=float).T
+    order = numpy.lexsort((times, threads)) # ascending temporal order
+    threads = threads[order]
+    times = times[order]
+    starts = segment_starts(threads)
+    counts = numpy.diff(numpy.r_[starts, len(times)])
+    last = numpy.repeat(times[starts + counts - 1], counts)
+    notLast = numpy.ones(len(times), dtype=bool)
+    notLast[starts + counts - 1] = False
+    roc = (last - times)[notLast]
     roc.sort()
     return roc
 
 def subjects_roc(subjectDict, msgThread, maxDays=9999999):
-    roc = []
-    ntp = 0.
-    subjectFP = {}
-    for subject, messages in subjectDict.items():
-        l = [(msgDate, msgThread[uid]) for (uid,msgDate) in messages
-             if uid in msgThread] # assess vs. known threads
-        if len(l) < 2: # no pairs to assess
-            continue
-        l.sort() # sort in ascending temporal order
-        n = npair = 0
-        for i,t in enumerate(l):
-            msgDate1, thread1 = t
-            for msgDate2, thread2 in l[i + 1:]:
-                timediff = msgDate2 - msgDate1
-                if timediff.days > maxDays:
-                    continue
-                if thread1 == thread2: # true positive
-                    tp = 1
-                else: # false positive
-                    tp = 0
-                roc.append((timediff, tp))
-                n += tp
-                npair += 1
-        ntp += n
-        subjectFP[subject] = (npair - n, npair) # save FP count
-    roc.sort() # in order of timediff, smallest first
-    nfp = len(roc) - ntp # total false positives
-    tpsum = fpsum = 0
-    l = []
-    for timediff, tp in roc: # compute ROC curve
-        tpsum += tp
-        fpsum += 1 - tp
-        l.append((timediff, tpsum / ntp, fpsum / nfp))
-    return l, subjectFP, nfp / len(roc)
+    '''assess every pair of messages with the same subject (and a known
+    thread) as true positive if in the same thread, else false positive.
+    Returns ROC curve as array of rows (timediff seconds, TPR, FPR)
+    ordered by timediff, {subject:(nFP, npair)}, and overall FP rate'''
+    subjects, sidx, uids, times, threads = subject_arrays(subjectDict,
+                                                          msgThread)
+    starts = segment_starts(sidx)
+    counts = numpy.diff(numpy.r_[starts, len(sidx)])
+    pos = numpy.arange(len(sidx)) - numpy.repeat(starts, counts)
+    later = numpy.repeat(counts, counts) - pos - 1 # pairs with later msgs
+    i = numpy.repeat(numpy.arange(len(sidx)), later)
+    offsets = numpy.repeat(numpy.cumsum(later) - later, later)
+    j = i + 1 + numpy.arange(len(i)) - offsets
+    timediff = times[j] - times[i]
+    ok = numpy.floor(timediff / 86400.) <= maxDays # whole days
+    i, j, timediff = i[ok], j[ok], timediff[ok]
+    tp = (threads[i] == threads[j]).astype(int) # true positive
+    npair = numpy.bincount(sidx[i], minlength=len(subjects))
+    ntpSubject = numpy.bincount(sidx[i], weights=tp, minlength=len(subjects))
+    subjectFP = dict([(subject, (int(npair[k] - ntpSubject[k]), int(npair[k])))
+                      for k, subject in enumerate(subjects)]) # save FP count
+    order = numpy.lexsort((tp, timediff)) # in order of timediff, smallest first
+    tp = tp[order]
+    ntp = float(tp.sum())
+    nfp = len(tp) - ntp # total false positives
+    roc = numpy.column_stack((timediff[order], numpy.cumsum(tp) / ntp,
+                              numpy.cumsum(1 - tp) / nfp))
+    return roc, subjectFP, nfp / len(tp)
+
+def get_subject_fusions(c, msgThread, subjectP=0.004, linkP=0.2):
+    '''get [(uid, uid2),] links between consecutive messages with the same
+    subject, except for subjects too unreliable to link by, judged
+    against how long real threads last'''
+    threadTimes = threadtime_roc(c, msgThread)
+    subjectFusions = subject_unreliability(get_subjects(c), threadTimes,
+                                           subjectP, linkP)[1]
+    return [(uid, uid2) for links in subjectFusions.values()
+            for p, uid, uid2 in links]
 
 def extract_references(headers):            
     references = headers.get('references', '').split()
@@ -480,24 +1397,22 @@ class MsgThreadDict(object):
 
 
 
-def get_references(c, newOnly=True, tableName='messages'):
+def get_references(c, newOnly=True, tableName='messages', refsTable='msgrefs'):
     'get {uid:[ref_msgid,]} refs and {msgid:uid} mapping'
     if newOnly:
-        c.execute('select id,msgid,headers from %s where myThread="NEW"'
-                  % tableName)
+        source = '%s m indexed by new_messages' % tableName
+        where = "m.myThread='NEW'"
     else:
-        c.execute('select id,msgid,headers from %s' % tableName)
+        source = '%s m' % tableName
+        where = '1'
+    c.execute('select r.id,r.ref from %s cross join %s r where r.id=m.id and %s'
+              % (source, refsTable, where))
     uidDict = {}
-    msgDict = {}
-    for uid,msgID,headers in c.fetchall():
-        if not headers:
-            continue
-        headers = json.loads(headers)
-        references = extract_references(headers)
-        if references:
-            uidDict[uid] = references
-        if msgID:
-            msgDict[msgID] = uid
+    for uid,ref in c.fetchall():
+        uidDict.setdefault(uid, []).append(ref)
+    c.execute('select m.id,m.msgid from %s where %s and m.msgid is not null'
+              % (source, where))
+    msgDict = dict([(msgID, uid) for uid,msgID in c.fetchall()])
     return uidDict, msgDict
 
 def get_thread_graph(c, tableName='messages'):
@@ -513,14 +1428,104 @@ def get_thread_graph(c, tableName='messages'):
             msgDict[msgID] = uid
     return msgGraph, msgDict
 
-def get_dup_msgids(c, tableName='messages'):
-    c.execute('select min(m1.id),m2.id from %s m1, %s m2 where m1.id<m2.id and m1.msgid is not null and m1.msgid=m2.msgid group by m2.id'
-              % (tableName,tableName))
+def get_dup_messages(c, tableName='messages'):
+    '''get [(uid, uid2),] linking each later copy of a message to its
+    first copy, in one pass over the fingerprint index'''
+    c.execute('''select d.id, m.id from %s m,
+                 (select fingerprint, min(id) id from %s
+                  where fingerprint is not null
+                  group by fingerprint having count(*)>1) d
+                 where m.fingerprint=d.fingerprint and m.id>d.id'''
+              % (tableName, tableName))
     return c.fetchall()
 
-def delete_dups(c, dups, tableName='messages'):
-    for uid,uid2 in dups:
-        c.execute('delete from %s where id=?' % tableName, (uid2,))
+def delete_dups(c, dups, tableName='messages', refsTable='msgrefs',
+                forestTable='threadforest', statsTable='sender_stats',
+                journalTable='verdict_journal', flagJournal='flag_journal'):
+    '''delete the later copy uid2 (and its references) of each (uid, uid2)
+    from get_dup_messages(), taking the deleted copies out of sender_stats
+    counters (rescoring those senders), the thread forest and
+    thread_replies.  Each thread that lost a copy is re-rooted if needed
+    (or dissolved if one message is left), and journaled so the next
+    thread_new_messages() rechecks its myThread.  Returns {id:threadID}
+    of remaining messages whose threadID changed'''
+    deleted = set([uid2 for uid, uid2 in dups])
+    stage_ids(c, deleted)
+    goodVerdicts = get_scoring(c)[0]
+    deltas = {} # {sender:[relevant, total, kept, trashed]}
+    if goodVerdicts is not None: # else counters get rebuilt anyway
+        c.execute('''select m.senderID, m.myThread, m.fromMe=0 and
+                     m.msgid is not null and m.subject is not null,
+                     m.verdict, j.id is not null, j.verdict
+                     from id_tmp t cross join %s m left join %s j on j.id=m.id
+                     where m.id=t.id and m.senderID is not null
+                     and m.myThread is not 'NEW' ''' % (tableName, journalTable))
+        for sender, myThread, counted, verdict, journaled, oldVerdict \
+                in c.fetchall():
+            delta = deltas.setdefault(sender, [0, 0, 0, 0])
+            if journaled: # counters still hold its old verdict
+                verdict = oldVerdict
+            if verdict is not None:
+                delta[2 + (verdict not in goodVerdicts)] -= 1
+            if counted:
+                delta[0] -= myThread == 1
+                delta[1] -= 1
+    c.execute('''select distinct m.threadID from id_tmp t cross join %s m
+                 where m.id=t.id and m.threadID is not null''' % tableName)
+    threads = [t[0] for t in c.fetchall()]
+    c.execute('''select f.id, f.rank from id_tmp t cross join %s f
+                 where f.id=t.id''' % forestTable)
+    ranks = dict(c.fetchall()) # of deleted nodes (if stored)
+    for table in (tableName, refsTable, forestTable, journalTable,
+                  flagJournal):
+        c.execute('delete from %s where id in (select id from id_tmp)'
+                  % table)
+    relabeled = {}
+    roots = []
+    for threadID in threads: # flatten, since inner nodes may be gone
+        c.execute('select id from %s where threadID=?' % tableName,
+                  (threadID,))
+        members = [t[0] for t in c.fetchall()]
+        if len(members) == 1: # no longer linked to anything
+            uid = members[0]
+            c.execute('''select senderID, myThread, fromMe=0 and msgid is not
+                         null and subject is not null from %s where id=?'''
+                      % tableName, (uid,))
+            sender, myThread, counted = c.fetchone()
+            if goodVerdicts is not None and sender is not None and counted:
+                deltas.setdefault(sender, [0, 0, 0, 0])[0] -= myThread == 1
+            c.execute('update %s set threadID=NULL, myThread=NULL where id=?'
+                      % tableName, (uid,))
+            c.execute('delete from %s where id=?' % forestTable, (uid,))
+            relabeled[uid] = None
+            continue
+        elif not members:
+            continue
+        if threadID in deleted: # root deleted: promote a remaining copy
+            root = min(members)
+            rank = ranks.get(threadID, 0)
+            c.execute('update %s set threadID=? where threadID=?'
+                      % tableName, (root, threadID))
+            relabeled.update([(uid, root) for uid in members])
+        else: # a root may not be stored yet
+            root = threadID
+            c.execute('select rank from %s where id=?' % forestTable,
+                      (root,))
+            rank = (c.fetchone() or (0,))[0]
+        c.executemany('insert or replace into %s values (?,?,?)'
+                      % forestTable, [(uid, root, uid == root and max(rank, 1)
+                                       or 0) for uid in members])
+        c.execute('insert or ignore into %s values (?)' % flagJournal,
+                  (root,))
+        roots.append(root)
+    update_thread_replies(c, roots, threads, tableName)
+    c.executemany('''update %s set relevant=relevant+?, total=total+?,
+                     kept=kept+?, trashed=trashed+? where id=?'''
+                  % statsTable, [tuple(delta) + (sender,)
+                                 for sender, delta in deltas.items()])
+    if deltas:
+        score_senders(c, set(deltas))
+    return relabeled
 
 def add_dup_edges(dups, msgGraph=None):
     if msgGraph is None:
@@ -566,22 +1571,110 @@ def build_graph(uidDict, msgDict, msgGraph=None):
                 pass
     return msgGraph
 
-def thread_dfs(uid, threadID, msgThread, threadMsgs, msgGraph):
-    msgThread[uid] = threadID
-    threadMsgs[threadID].append(uid)
-    for uid2 in msgGraph[uid]:
-        if uid2 not in msgThread:
-            thread_dfs(uid2, threadID, msgThread, threadMsgs, msgGraph)
-
 def get_threads(msgGraph):
+    'label connected components of msgGraph, using an explicit stack'
     msgThread = {}
     threadMsgs = {}
-    for uid in msgGraph:
-        if uid not in msgThread:
-            threadMsgs[uid] = []
-            thread_dfs(uid, uid, msgThread, threadMsgs, msgGraph)
+    for threadID in msgGraph:
+        if threadID in msgThread:
+            continue
+        msgs = threadMsgs[threadID] = []
+        msgThread[threadID] = threadID
+        stack = [threadID]
+        while stack:
+            uid = stack.pop()
+            msgs.append(uid)
+            for uid2 in msgGraph[uid]:
+                if uid2 not in msgThread:
+                    msgThread[uid2] = threadID
+                    stack.append(uid2)
     return threadMsgs, msgThread
 
+def get_edge_arrays(c, tableName='messages', refsTable='msgrefs'):
+    '''get all thread edges (references, and copies of the same message)
+    as two numpy arrays of message ids'''
+    c.execute('select r.id, m.id from %s r, %s m where m.msgid=r.ref'
+              % (refsTable, tableName))
+    edges = numpy.fromiter(chain.from_iterable(c), dtype=numpy.int64)
+    dups = numpy.array(get_dup_messages(c, tableName),
+                       dtype=numpy.int64).reshape(-1)
+    edges = numpy.concatenate((edges, dups))
+    return edges[0::2], edges[1::2]
+
+def label_threads(ids, src, dst):
+    '''label connected components of the graph on sorted message ids
+    with edges (src, dst), via a sparse CSR adjacency matrix.  Returns
+    array of the threadID (smallest id in its component) of each
+    message, or -1 for messages not linked to any other'''
+    ok = numpy.in1d(src, ids) & numpy.in1d(dst, ids)
+    i = numpy.searchsorted(ids, src[ok])
+    j = numpy.searchsorted(ids, dst[ok])
+    n = len(ids)
+    graph = sparse.csr_matrix((numpy.ones(len(i), dtype=numpy.int32), (i, j)),
+                              shape=(n, n))
+    ncomponents, labels = csgraph.connected_components(graph, directed=False)
+    first = numpy.unique(labels, return_index=True)[1] # ids are sorted
+    threadIDs = ids[first][labels]
+    threadIDs[numpy.bincount(labels)[labels] == 1] = -1
+    return threadIDs
+
+def rebuild_threads(c, goodVerdicts, fuseSubjects=False, tableName='messages',
+                    refsTable='msgrefs', forestTable='threadforest',
+                    journalTable='flag_journal', tmpTable='thread_tmp'):
+    '''rethread all messages in one connected_components() pass over
+    the edge arrays, writing back threadID and myThread of changed rows
+    with one bulk UPDATE, and rebuilding the thread forest, thread replies and sender
+    stats and scores to match.  Subject fusions made by earlier rounds
+    are discarded, unless fuseSubjects, which recomputes them (see
+    get_subject_fusions()) on the rebuilt threads and labels again.
+    Returns (msgThread, myThreads) like reanalyze_threads()'''
+    print 'rebuilding threads...'
+    c.execute('select id from %s order by id' % tableName)
+    ids = numpy.fromiter((t[0] for t in c), dtype=numpy.int64)
+    src, dst = get_edge_arrays(c, tableName, refsTable)
+    threadIDs = label_threads(ids, src, dst)
+    if fuseSubjects:
+        print 'fusing threads by subject...'
+        threaded = threadIDs >= 0
+        fusions = get_subject_fusions(c, dict(zip(ids[threaded].tolist(),
+                                                  threadIDs[threaded].tolist())))
+        if fusions:
+            fusions = numpy.array(fusions, dtype=numpy.int64)
+            src = numpy.concatenate((src, fusions[:, 0]))
+            dst = numpy.concatenate((dst, fusions[:, 1]))
+            threadIDs = label_threads(ids, src, dst)
+    c.execute('select id from %s where fromMe=1 or flagbits&%d order by id'
+              % (tableName, FLAG_REPLIED))
+    myMsgs = numpy.fromiter((t[0] for t in c), dtype=numpy.int64)
+    myThreads = numpy.unique(threadIDs[numpy.searchsorted(ids, myMsgs)])
+    myThreads = myThreads[myThreads >= 0]
+    threaded = threadIDs >= 0
+    ids = ids[threaded]
+    threadIDs = threadIDs[threaded]
+    _temp_table(c, tmpTable, 'id integer primary key, threadID integer, '
+                'myThread integer')
+    c.executemany('insert into %s values (?,?,?)' % tmpTable,
+                  zip(ids.tolist(), threadIDs.tolist(),
+                      numpy.in1d(threadIDs, myThreads).astype(int).tolist()))
+    c.execute('''update %s set threadID=NULL, myThread=NULL
+                 where (threadID is not null or myThread is not null)
+                 and id not in (select id from %s)''' % (tableName, tmpTable))
+    changed = '''%s.threadID is not t.threadID
+                 or %s.myThread is not t.myThread''' % (tableName, tableName)
+    update_from_temp(c, tableName, tmpTable, ('threadID', 'myThread'),
+                     where=changed)
+    c.execute('delete from %s' % forestTable)
+    c.execute('''insert into %s select id, threadID,
+                 case when id=threadID then 1 else 0 end from %s'''
+              % (forestTable, tmpTable))
+    c.execute('delete from %s' % journalTable) # myThread is now current
+    rebuild_thread_replies(c, tableName)
+    rebuild_sender_stats(c, goodVerdicts, tableName)
+    print 'updating addrs db...'
+    score_senders(c)
+    return (dict(zip(ids.tolist(), threadIDs.tolist())),
+            set(myThreads.tolist()))
+
 def get_my_threads(c, myMsgs, msgThread):
     myThreads = set()
     def add_msg(uid):
@@ -591,49 +1684,353 @@ def get_my_threads(c, myMsgs, msgThread):
             pass
     for i in myMsgs: # messages from me
         add_msg(i)
-    c.execute('select id from messages where flags not null and flags not like "IMAP:%" and (flags like "%P%" or flags like "%R%")')
-    for t in c.fetchall(): # maildir messages I answered or forwarded
-        add_msg(t[0])
-    c.execute('select id from messages where flags like "IMAP%\\Answered%" or flags like "IMAP%$Forwarded%"')
-    for t in c.fetchall(): # IMAP messages I answered or forwarded
+    c.execute('select id from messages where flagbits&?', (FLAG_REPLIED,))
+    for t in c.fetchall(): # messages I answered or forwarded
         add_msg(t[0])
     return myThreads
 
-def reanalyze_threads(c):
-    'add new messages to existing thread graph'
-    print 'reanalyzing thread graph...'
-    msgGraph, msgDict = get_thread_graph(c) # get old graph edges
-    refsDict = get_references(c)[0] # get new graph edges
-    msgGraph = build_graph(refsDict, msgDict, msgGraph)
-    threadMsgs, msgThread = get_threads(msgGraph) # clique analysis
-    myMsgs = get_my_message_ids(c)
-    myThreads = get_my_threads(c, myMsgs, msgThread) # threads I participated in
-    print 'updating threads db...'
-    update_message_threads(c, threadMsgs, myThreads)
-    print 'analyzing addr counts...'
-    addrCounts = get_sender_counts(iter_senders(c), msgThread, myThreads)
-    low, high = get_sender_pvals(addrCounts)
+class ThreadForest(object):
+    '''union-find (parent, rank) over message ids, persisted in
+    forestTable so that each round only merges the edges of NEW
+    messages.  Nodes are loaded on demand and cached; flush() writes
+    back the changed ones.  The root of each tree is its threadID.'''
+    def __init__(self, c, tableName='threadforest'):
+        self.c = c
+        self.tableName = tableName
+        self.parent = {}
+        self.rank = {}
+        self.dirty = set()
+
+    def load(self, uids, tmpTable='id_tmp'):
+        'cache the nodes for uids in one query, instead of one per node'
+        stage_ids(self.c, uids, tmpTable)
+        self.c.execute('''select f.id, f.parent, f.rank from %s t
+                          cross join %s f where f.id=t.id'''
+                       % (tmpTable, self.tableName))
+        for uid in uids: # not yet in any thread
+            self.parent[uid], self.rank[uid] = uid, 0
+        for uid, parent, rank in self.c.fetchall():
+            self.parent[uid] = parent
+            self.rank[uid] = rank
+
+    def _get_parent(self, uid):
+        try:
+            return self.parent[uid]
+        except KeyError:
+            self.c.execute('select parent,rank from %s where id=?'
+                           % self.tableName, (uid,))
+            t = self.c.fetchone()
+            if t is None: # not yet in any thread
+                t = (uid, 0)
+            self.parent[uid], self.rank[uid] = t
+            return t[0]
+
+    def find(self, uid):
+        'get root of uid, halving its path (iterative, so no recursion limit)'
+        while True:
+            parent = self._get_parent(uid)
+            if parent == uid:
+                return uid
+            grandparent = self._get_parent(parent)
+            if grandparent != parent:
+                self.parent[uid] = grandparent
+                self.dirty.add(uid)
+            uid = grandparent
+
+    def union(self, uid, uid2):
+        '''join the threads of uid and uid2 by rank; returns
+        (root, absorbedRoot), or None if already in the same thread'''
+        root = self.find(uid)
+        root2 = self.find(uid2)
+        if root == root2:
+            return None
+        if self.rank[root] < self.rank[root2]:
+            root, root2 = root2, root
+        self.parent[root2] = root
+        self.dirty.add(root2)
+        if self.rank[root] == self.rank[root2]:
+            self.rank[root] += 1
+            self.dirty.add(root)
+        return root, root2
+
+    def flush(self):
+        'save changed nodes to the db'
+        self.c.executemany('insert or replace into %s values (?,?,?)'
+                           % self.tableName,
+                           [(uid, self.parent[uid], self.rank[uid])
+                            for uid in self.dirty])
+        self.dirty.clear()
+
+def get_new_edges(c, tableName='messages', refsTable='msgrefs'):
+    '''get [(uid, uid2),] thread edges added by NEW messages: their
+    own references, older messages that referenced them in advance,
+    and other copies of the same message (same fingerprint)'''
+    refsDict, msgDict = get_references(c, True, tableName, refsTable)
+    refIDs = get_msgid_uids(c, set([r for refs in refsDict.values()
+                                    for r in refs]), tableName)
+    edges = [(uid, refIDs[r]) for uid, refs in refsDict.items()
+             for r in refs if r in refIDs]
+    stage_msgids(c, [(msgID, None) for msgID in msgDict])
+    c.execute('''select r.id, m.id from msgid_tmp t cross join %s r
+                 cross join %s m where r.ref=t.msgid and m.msgid=t.msgid'''
+              % (refsTable, tableName))
+    edges += c.fetchall()
+    c.execute('''select m.id, min(d.id) from %s m indexed by new_messages
+                 cross join %s d
+                 where m.myThread='NEW' and d.fingerprint=m.fingerprint
+                 and d.id!=m.id group by m.id''' % (tableName, tableName))
+    edges += c.fetchall() # link copies of the same message
+    return [(uid, uid2) for uid, uid2 in edges if uid != uid2]
+
+def get_my_thread_ids(c, tableName='messages'):
+    'get set of threads containing a message I sent, answered or forwarded'
+    c.execute('''select distinct threadID from %s where threadID is not null
+                 and (fromMe=1 or flagbits&%d)''' % (tableName, FLAG_REPLIED))
+    return set([t[0] for t in c.fetchall()])
+
+def thread_new_messages(c, extraEdges=(), myThreads=None,
+                        tableName='messages', refsTable='msgrefs',
+                        forestTable='threadforest',
+                        journalTable='flag_journal', tmpTable='mythread_tmp'):
+    '''merge the edges of NEW messages (plus any extraEdges, e.g. from
+    get_subject_fusions()) into the persistent thread forest, writing
+    back threadID and myThread only for rows whose value changed.
+    myThread is only rechecked in threads that gained messages, or
+    whose flags changed (see save_flags()), and the set myThreads of
+    my threads (loaded from db if None) is updated in place.
+    Returns {id:threadID} of relabeled rows, the set of my threads,
+    and {id:(oldMyThread, myThread)} of rows whose myThread changed'''
+    if myThreads is None:
+        myThreads = get_my_thread_ids(c, tableName)
+    forest = ThreadForest(c, forestTable)
+    edges = get_new_edges(c, tableName, refsTable) + list(extraEdges)
+    forest.load(set([uid for edge in edges for uid in edge]))
+    uids = set()
+    absorbed = []
+    for uid, uid2 in edges:
+        uids.add(uid)
+        uids.add(uid2)
+        t = forest.union(uid, uid2)
+        if t:
+            absorbed.append(t[1])
+    labels = {} # {id:threadID} currently stored
+    stage_ids(c, uids)
+    c.execute('select m.id, m.threadID from id_tmp t cross join %s m where m.id=t.id'
+              % tableName)
+    labels.update(c.fetchall())
+    for threadID in absorbed: # its members all need relabeling
+        c.execute('select id from %s where threadID=?' % tableName,
+                  (threadID,))
+        for t in c.fetchall():
+            labels[t[0]] = threadID
+    relabeled = {}
+    for uid, threadID in labels.items():
+        root = forest.find(uid)
+        if root != threadID:
+            relabeled[uid] = root
+    forest.flush()
+    c.executemany('update %s set threadID=? where id=?' % tableName,
+                  [(threadID, uid) for uid, threadID in relabeled.items()])
+    c.execute('''select m.threadID from %s j cross join %s m
+                 where m.id=j.id and m.threadID is not null'''
+              % (journalTable, tableName))
+    threads = set(relabeled.values()) | set([t[0] for t in c.fetchall()])
+    c.execute('delete from %s' % journalTable)
+    myThreads.difference_update(absorbed)
+    myThreads.difference_update(threads)
+    stage_ids(c, threads, tmpTable)
+    c.execute('''select distinct m.threadID from %s t cross join %s m
+                 where m.threadID=t.id and (m.fromMe=1 or m.flagbits&%d)'''
+              % (tmpTable, tableName, FLAG_REPLIED))
+    myThreads.update([t[0] for t in c.fetchall()])
+    c.execute('''select m.id, m.myThread, m.threadID from %s t
+                 cross join %s m where m.threadID=t.id''' % (tmpTable, tableName))
+    changes = {}
+    for uid, old, threadID in c.fetchall():
+        new = int(threadID in myThreads)
+        if old != new:
+            changes[uid] = (old, new)
+    c.executemany('update %s set myThread=? where id=?' % tableName,
+                  [(new, uid) for uid, (old, new) in changes.items()])
+    c.execute("select id from %s indexed by new_messages where myThread='NEW'"
+              % tableName)
+    for t in c.fetchall(): # NEW messages not in any thread
+        changes[t[0]] = ('NEW', None)
+    c.execute("update %s set myThread=NULL where myThread='NEW'" % tableName)
+    update_thread_replies(c, threads, absorbed, tableName)
+    return relabeled, myThreads, changes
+
+def update_thread_replies(c, threads, absorbed=(), tableName='messages',
+                          repliesTable='thread_replies'):
+    '''recompute my last reply date for the specified threads, and drop
+    the entries of absorbed threads that no longer exist'''
+    c.executemany('delete from %s where threadID=?' % repliesTable,
+                  [(threadID,) for threadID in absorbed])
+    stage_ids(c, threads)
+    c.execute('''insert or replace into %s select m.threadID, max(m.date)
+                 from id_tmp t cross join %s m where m.threadID=t.id
+                 and m.fromMe=1 group by m.threadID'''
+              % (repliesTable, tableName))
+
+def rebuild_thread_replies(c, tableName='messages',
+                           repliesTable='thread_replies'):
+    'recompute my last reply date for every thread'
+    create_replies_table(c, repliesTable, tableName)
+    c.execute('delete from %s' % repliesTable)
+    c.execute('''insert into %s select threadID, max(date) from %s
+                 where fromMe=1 and threadID is not null group by threadID'''
+              % (repliesTable, tableName))
+
+def load_threads(c, tableName='messages'):
+    'get {id:threadID} mapping and set of my threads from db'
+    c.execute('select id, threadID from %s where threadID is not null'
+              % tableName)
+    return dict(c.fetchall()), get_my_thread_ids(c, tableName)
+
+def update_sender_stats(c, changes, goodVerdicts, tableName='messages',
+                        statsTable='sender_stats',
+                        journalTable='verdict_journal'):
+    '''apply deltas to sender_stats counters for messages newly threaded
+    or whose myThread changed ({id:(oldMyThread, myThread)} from
+    thread_new_messages()), and for verdicts changed since the last call.
+    Returns set of sender ids whose counters changed, or None if all
+    counters had to be rebuilt (e.g. because goodVerdicts changed)'''
+    if get_scoring(c)[0] != list(goodVerdicts):
+        rebuild_sender_stats(c, goodVerdicts, tableName, statsTable,
+                             journalTable)
+        return None
+    deltas = {} # {sender:[relevant, total, kept, trashed]}
+    def add_verdict(sender, verdict, n):
+        if verdict is not None:
+            delta = deltas.setdefault(sender, [0, 0, 0, 0])
+            if verdict in goodVerdicts:
+                delta[2] += n
+            else:
+                delta[3] += n
+    stage_ids(c, changes)
+    c.execute('''select m.id, m.senderID, m.verdict, m.fromMe=0 and
+                 m.msgid is not null and m.subject is not null
+                 from id_tmp t cross join %s m where m.id=t.id
+                 and m.senderID is not null''' % tableName)
+    for uid, sender, verdict, counted in c.fetchall():
+        old, new = changes[uid]
+        if old == 'NEW': # not counted until threaded
+            add_verdict(sender, verdict, 1)
+        if counted:
+            delta = deltas.setdefault(sender, [0, 0, 0, 0])
+            delta[0] += (new == 1) - (old == 1)
+            delta[1] += old == 'NEW'
+    c.execute('''select m.senderID, j.verdict, m.verdict from %s j
+                 cross join %s m where j.id=m.id and m.senderID is not null'''
+              % (journalTable, tableName))
+    for sender, oldVerdict, verdict in c.fetchall():
+        add_verdict(sender, oldVerdict, -1)
+        add_verdict(sender, verdict, 1)
+    c.execute('delete from %s' % journalTable)
+    c.executemany('insert or ignore into %s (id) values (?)' % statsTable,
+                  [(sender,) for sender in deltas])
+    c.executemany('''update %s set relevant=relevant+?, total=total+?,
+                     kept=kept+?, trashed=trashed+? where id=?'''
+                  % statsTable, [tuple(delta) + (sender,)
+                                 for sender, delta in deltas.items()])
+    return set(deltas)
+
+def rebuild_sender_stats(c, goodVerdicts, tableName='messages',
+                         statsTable='sender_stats',
+                         journalTable='verdict_journal'):
+    'recount all sender_stats counters from the messages table'
+    print 'rebuilding sender stats...'
+    c.execute('delete from %s' % statsTable)
+    c.execute('delete from %s' % journalTable)
+    c.execute('''insert into %s select senderID, sum(myThread is 1), count(*), 0, 0
+                 from %s where fromMe=0 and msgid is not null
+                 and subject is not null and senderID is not null
+                 and myThread is not 'NEW'
+                 group by senderID''' % (statsTable, tableName))
+    rows = count_sender_verdicts(c, goodVerdicts, tableName)
+    c.executemany('insert or ignore into %s (id) values (?)' % statsTable,
+                  [t[:1] for t in rows])
+    c.executemany('update %s set kept=?, trashed=? where id=?'
+                  % statsTable, [(kept, trashed, sender)
+                                 for sender, kept, trashed in rows])
+    save_scoring(c, goodVerdicts, None, None)
+
+def get_scoring(c, tableName='sender_scoring'):
+    '''get goodVerdicts and (nrelevant, ntotal) totals used by the last
+    full scoring of senders'''
+    c.execute('select goodVerdicts, nrelevant, ntotal from %s' % tableName)
+    t = c.fetchone()
+    if t is None:
+        return None, None, None
+    return json.loads(t[0]), t[1], t[2]
+
+def save_scoring(c, goodVerdicts, M, N, tableName='sender_scoring'):
+    c.execute('delete from %s' % tableName)
+    c.execute('insert into %s values (?,?,?)' % tableName,
+              (json.dumps(list(goodVerdicts)), M, N))
+
+def score_senders(c, senders=None, maxDrift=0.01, statsTable='sender_stats'):
+    '''recompute p-values (addrs, junkaddrs) and verdict LOD scores
+    (verdictaddrs) from sender_stats, for the specified sender ids only.
+    P-values also depend on the totals over all senders, so all are
+    rescored if senders is None, or once either total has drifted by
+    more than maxDrift (fraction) since the last full scoring'''
+    if senders is not None and not senders: # no counters changed
+        return [], []
+    c.execute('select sum(relevant), sum(total) from %s' % statsTable)
+    M, N = [v or 0 for v in c.fetchone()]
+    goodVerdicts, scoredM, scoredN = get_scoring(c)
+    if senders is None or scoredN is None or \
+           abs(M - scoredM) > maxDrift * scoredM or \
+           abs(N - scoredN) > maxDrift * scoredN:
+        print 'scoring all senders...'
+        c.execute('select id, relevant, total, kept, trashed from %s'
+                  % statsTable)
+        rows = c.fetchall()
+        for name in ('addrs', 'junkaddrs', 'verdictaddrs'):
+            create_addrs_table(c, name)
+        save_scoring(c, goodVerdicts, M, N)
+    else:
+        rows = []
+        for sender in senders:
+            c.execute('''select id, relevant, total, kept, trashed
+                         from %s where id=?''' % statsTable, (sender,))
+            rows += c.fetchall()
+    low, high = get_sender_pvals(dict([(t[0], t[1:3]) for t in rows
+                                       if t[2]]), M, N)
+    save_addrs(c, high, replace=True)
+    save_addrs(c, low, 'junkaddrs', replace=True)
+    save_addrs(c, [(verdict_lod(kept, trashed), kept, kept + trashed, a)
+                   for a, relevant, total, kept, trashed in rows
+                   if kept or trashed], 'verdictaddrs', replace=True)
+    return low, high
+
+def reanalyze_threads(c, goodVerdicts, msgThread=None, fuseSubjects=False,
+                      myThreads=None):
+    '''add NEW messages to the persistent thread forest, and update sender
+    stats and scores for senders whose counters changed.  Updates
+    msgThread {id:threadID} and the set myThreads in place if given,
+    else loads them from db.  If fuseSubjects, also links messages by
+    subject (see get_subject_fusions()).  Returns (msgThread, myThreads)'''
+    if msgThread is None or myThreads is None:
+        msgThread, myThreads = load_threads(c)
+    fusions = ()
+    if fuseSubjects:
+        print 'fusing threads by subject...'
+        fusions = get_subject_fusions(c, msgThread)
+    print 'threading new messages...'
+    relabeled, myThreads, changes = thread_new_messages(c, fusions, myThreads)
+    msgThread.update(relabeled)
+    print 'updating sender stats...'
+    senders = update_sender_stats(c, changes, goodVerdicts)
     print 'updating addrs db...'
-    create_addrs_table(c)
-    save_addrs(c, high)
-    create_addrs_table(c, 'junkaddrs')
-    save_addrs(c, low, 'junkaddrs')
-    return threadMsgs, msgThread, myThreads, low, high
+    score_senders(c, senders)
+    return msgThread, myThreads
 
 def iter_senders(c):
-    c.execute('select id,headers from messages where fromMe=0 and msgid is not null and subject is not null')
-    for uid, headers in c.fetchall():
-        if not headers:
-            continue
-        headers = json.loads(headers)
-        try:
-            fromAddrs = headers['from']
-        except KeyError:                    
-            pass
-        t = email.utils.parseaddr(fromAddrs)
-        sender = t[1].lower()
-        if sender:
-            yield uid, sender
+    c.execute('select id,senderID from messages where fromMe=0 and msgid is not null and subject is not null and senderID is not null')
+    for uid, sender in c.fetchall():
+        yield uid, sender
 
 def get_sender_counts(senders, msgThread, myThreads, addrCounts=None):
     if addrCounts is None:
@@ -651,48 +2048,75 @@ def get_sender_counts(senders, msgThread, myThreads, addrCounts=None):
         addrCounts[k] = (sum(v), len(v))
     return addrCounts
 
-def get_sender_pvals(addrCounts):
-    M = sum([t[0] for t in addrCounts.values()])
-    N = sum([t[1] for t in addrCounts.values()])
+_pvalCache = {} # {(N, M, n, k):(low, high)}
+
+def hypergeom_pvals(counts, M, N, cache=_pvalCache, maxCache=100000):
+    '''get {(k, n):(low, high)} hypergeometric tail p-values for
+    k relevant out of n, given M relevant out of N in total.  Pairs not
+    already cached are scored together in one array call'''
+    if len(cache) > maxCache:
+        cache.clear()
+    todo = [t for t in set(counts) if (N, M, t[1], t[0]) not in cache]
+    if todo:
+        k = numpy.array([t[0] for t in todo])
+        n = numpy.array([t[1] for t in todo])
+        # cdf(k) as sf of the non-relevant count, since hypergeom.cdf()
+        # cannot broadcast over n in older scipy
+        lowP = stats.hypergeom.sf(n - k - 1, N, N - M, n)
+        highP = stats.hypergeom.sf(k - 1, N, M, n)
+        for i in numpy.flatnonzero(numpy.isnan(highP)):
+            # old version of hypergeom.sf() gives NaN, yuck
+            highP[i] = stats.hypergeom.pmf(range(k[i], n[i] + 1), 
+                                           N, M, n[i]).sum()
+        for i, t in enumerate(todo):
+            cache[(N, M, t[1], t[0])] = (lowP[i], highP[i])
+    return dict([(t, cache[(N, M, t[1], t[0])]) for t in counts])
+
+def get_sender_pvals(addrCounts, M=None, N=None):
+    'M, N default to totals over addrCounts'
+    if M is None:
+        M = sum([t[0] for t in addrCounts.values()])
+    if N is None:
+        N = sum([t[1] for t in addrCounts.values()])
+    pvals = hypergeom_pvals([tuple(t) for t in addrCounts.values()], M, N)
     low = []
     high = []
     for k,t in addrCounts.items():
-        h = stats.hypergeom(N, M, t[1])
-        low.append((h.cdf(t[0]), t[0], t[1], k))
-        p = h.sf(t[0] - 1)
-        if isnan(p): # old version of hypergeom.sf() gives NaN, yuck
-            p = h.pmf(range(t[0], t[1] + 1)).sum()
-        high.append((p, t[0], t[1], k))
+        pLow, pHigh = pvals[tuple(t)]
+        low.append((pLow, t[0], t[1], k))
+        high.append((pHigh, t[0], t[1], k))
     low.sort()
     high.sort()
     return low, high
 
+def verdict_lod(kept, trashed, junkP=0.001, notjunkP=0.5):
+    '''log likelihood odds ratio notjunk/junk for a sender with these
+    counts of kept / trashed email'''
+    keptLOD = log(notjunkP / junkP) # log likelihood odds ratio for kept email
+    trashLOD = log((1. - notjunkP) / (1. - junkP)) # LLODR for trashed email
+    return kept * keptLOD + trashed * trashLOD
+
+def count_sender_verdicts(c, goodVerdicts, tableName='messages'):
+    '''get [(senderID, kept, trashed)] counts of messages with a verdict,
+    aggregated in SQL (using the sender_verdict covering index)'''
+    c.execute('''select senderID, sum(verdict in (%s)), count(*) from %s
+                 where senderID is not null
+                 and verdict is not null and myThread is not 'NEW'
+                 group by senderID'''
+              % (','.join('?' * len(goodVerdicts)), tableName),
+              tuple(goodVerdicts))
+    return [(sender, kept, n - kept) for sender, kept, n in c.fetchall()]
+
 def get_sender_verdicts(c, goodVerdicts, junkP=0.001, notjunkP=0.5, 
                         tableName='messages'):
     '''compute log likelihood odds ratio for two competing models notjunk/junk
     notjunk address: email will be kept (triaged) with likelihood notjunkP
     junk address: email will be kept (triaged) with likelihood junkP.
-    returns [(LOD, m, n, address)] sorted with junk (lowest LOD) first'''
-    keptLOD = log(notjunkP / junkP) # log likelihood odds ratio for kept email
-    trashLOD = log((1. - notjunkP) / (1. - junkP)) # LLODR for trashed email
-    addrs = []
-    def save_data(a, k, t):
-        addrs.append((k * keptLOD + t * trashLOD, k, t + k, a))
-    c.execute('select sender, verdict from %s where verdict not null and myThread is not "NEW" order by sender' 
-              % tableName)
-    lastSender = None
-    for sender, verdict in c.fetchall():
-        if sender != lastSender:
-            if lastSender:
-                save_data(lastSender, kept, trashed)
-            lastSender = sender
-            kept = trashed = 0
-        if verdict in goodVerdicts:
-            kept += 1
-        else:
-            trashed += 1
-    if lastSender:
-        save_data(lastSender, kept, trashed)
+    returns [(LOD, m, n, senderID)] sorted with junk (lowest LOD) first'''
+    addrs = [(verdict_lod(kept, trashed, junkP, notjunkP), kept,
+              kept + trashed, sender)
+             for sender, kept, trashed in count_sender_verdicts(c, goodVerdicts,
+                                                                tableName)]
     addrs.sort()
     return addrs
 
@@ -740,10 +2164,14 @@ def get_counts(mailDir):
     return addrCounts
 
             
-def get_answered_messages(c, tableName='messages'):
-    'get unclosed messages with subsequent message fromMe in same thread'
-    c.execute('select t1.id, t1.msgID from %s t1, %s t2 where t2.fromMe=1 and t1.threadID=t2.threadID and t1.date < t2.date and t1.mailbox!="Closed" and t1.mailbox!="Sent" and t1.serverID>0' 
-              % (tableName, tableName))
+def get_answered_messages(c, tableName='messages',
+                          repliesTable='thread_replies'):
+    '''get unclosed messages with subsequent message fromMe in same thread,
+    as a range query on open_thread_date for each thread I replied to'''
+    c.execute('''select m.id, m.msgID from %s r, %s m
+                 where m.threadID=r.threadID and m.date < r.lastReply
+                 and m.mailbox!='Closed' and m.mailbox!='Sent'
+                 and m.serverID>0''' % (repliesTable, tableName))
     d = {}
     for uid, msgID in c.fetchall():
         d[msgID] = uid
@@ -0,0 +1,368 @@
+'''in-process stand-in for an IMAP server, for running and benchmarking
+respectmail offline (no live account needed).  FakeIMAPClient mimics
+the subset of the IMAPClient interface that respectmail uses, and
+counts commands issued and bytes transferred.  Use it via e.g.:
+
+  store = FakeIMAPStore('imap.example.com')
+  store.append('INBOX', headerText)
+  srv = imap.IMAPServer('imap.example.com', 'me', password='x')
+  srv.server.clientClass = FakeIMAPClient
+
+For imap.IMAPServer(..., pipelined=True) use FakePipelinedIMAPClient,
+which runs the real PipelinedIMAPClient.fetch_pipelined() over FakeIMAP4.
+'''
+import re
+import time
+import threading
+import imaplib
+import imap
+
+servers = {} # {host:FakeIMAPStore}
+
+SEEN = '\\Seen'
+DELETED = '\\Deleted'
+
+class FakeMailbox(object):
+    '''messages {uid:[text, set(flags), modseq]} of one folder.  While
+    any client is in IDLE, changes are logged as IDLE responses in events'''
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = {}
+        self.idlers = 0
+        self.events = []
+    def _log(self, uid, *response):
+        'log untagged response about uid, as (seq, type, ...)'
+        if self.idlers:
+            self.events.append((sorted(self.messages).index(uid) + 1,)
+                               + response)
+    def add(self, text, flags=()):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.modseq += 1
+        self.messages[uid] = [text, set(flags), self.modseq]
+        if self.idlers:
+            self.events.append((len(self.messages), 'EXISTS'))
+        return uid
+    def set_flags(self, uid, flags):
+        self.modseq += 1
+        msg = self.messages[uid]
+        msg[1] = flags
+        msg[2] = self.modseq
+        self._log(uid, 'FETCH', ('FLAGS', tuple(flags)))
+    def remove(self, uid):
+        self._log(uid, 'EXPUNGE')
+        del self.messages[uid]
+
+class FakeIMAPStore(object):
+    '''the mailboxes of one fake IMAP server, shared by all connections
+    to its host.  Keeps counts of commands and bytes sent to clients'''
+    def __init__(self, host, capabilities=('IMAP4REV1', 'IDLE', 'MOVE',
+                                            'UIDPLUS', 'CONDSTORE')):
+        self.host = host
+        self.capabilities = frozenset(capabilities)
+        self.folders = {}
+        self.changed = threading.Condition()
+        self.reset_stats()
+        servers[host] = self
+    def reset_stats(self):
+        self.commands = {}
+        self.bytes = 0
+    def count(self, command, nbytes=0):
+        self.commands[command] = self.commands.get(command, 0) + 1
+        self.bytes += nbytes
+    def ncommands(self):
+        return sum(self.commands.values())
+    def create_folder(self, folder):
+        if folder not in self.folders:
+            self.folders[folder] = FakeMailbox(int(time.time())
+                                               + len(self.folders))
+    def append(self, folder, text, flags=()):
+        'add a message to folder, notifying any IDLE clients'
+        self.create_folder(folder)
+        uid = self.folders[folder].add(text, flags)
+        self.notify()
+        return uid
+    def notify(self):
+        'wake IDLE clients to check their mailbox events'
+        with self.changed:
+            self.changed.notify_all()
+
+def get_header(text):
+    'get header portion (including final blank line) of message text'
+    m = re.search(r'\r?\n\r?\n', text)
+    if m:
+        return text[:m.end()]
+    return text
+
+def get_header_fields(text, fields):
+    'get header lines (with continuations) for the specified fields only'
+    lines = []
+    keep = False
+    for line in get_header(text).splitlines(True):
+        if not line.strip():
+            break
+        if line[0] not in ' \t':
+            keep = line.split(':', 1)[0].strip().upper() in fields
+        if keep:
+            lines.append(line)
+    return ''.join(lines) + '\r\n'
+
+class FakeIMAPClient(object):
+    'stand-in for imapclient.IMAPClient connected to a FakeIMAPStore'
+    use_uid = True
+    def __init__(self, host, *args, **kwargs):
+        self._store = servers[host]
+        self._folder = None
+        self._idleSeen = None
+    def _mailbox(self):
+        return self._store.folders[self._folder]
+    def _uids(self, messages):
+        'convert message list or set string like "1:*" to existing uids'
+        mailbox = self._mailbox()
+        if not isinstance(messages, basestring):
+            return [uid for uid in messages if uid in mailbox.messages]
+        uids = set()
+        allUIDs = sorted(mailbox.messages)
+        for r in messages.split(','):
+            if ':' in r:
+                start, stop = r.split(':')
+                start = int(start)
+                if stop == '*':
+                    stop = allUIDs and allUIDs[-1] or 0
+                    start = min(start, stop) # n:* includes last message
+                stop = int(stop)
+                uids.update([uid for uid in allUIDs if start <= uid <= stop])
+            elif int(r) in mailbox.messages:
+                uids.add(int(r))
+        return sorted(uids)
+
+    def login(self, user, password):
+        self._store.count('LOGIN')
+    def logout(self):
+        self._store.count('LOGOUT')
+    def has_capability(self, capability): # IMAPClient caches these
+        return capability.upper() in self._store.capabilities
+    def list_folders(self):
+        self._store.count('LIST')
+        return [((), '/', name) for name in sorted(self._store.folders)]
+    def create_folder(self, folder):
+        self._store.count('CREATE')
+        self._store.create_folder(folder)
+        return 'Create completed.'
+    def folder_status(self, folder, what=None):
+        self._store.count('STATUS')
+        mailbox = self._store.folders[folder]
+        return dict(MESSAGES=len(mailbox.messages), UIDNEXT=mailbox.uidnext,
+                    UIDVALIDITY=mailbox.uidvalidity,
+                    HIGHESTMODSEQ=mailbox.modseq)
+    def select_folder(self, folder, readonly=False):
+        self._store.count('SELECT')
+        self._folder = folder
+        mailbox = self._mailbox()
+        return {'EXISTS':len(mailbox.messages), 'UIDNEXT':mailbox.uidnext,
+                'UIDVALIDITY':mailbox.uidvalidity,
+                'HIGHESTMODSEQ':mailbox.modseq}
+
+    def search(self, criteria='ALL'):
+        self._store.count('SEARCH')
+        if not isinstance(criteria, basestring):
+            criteria = ' '.join(criteria)
+        tests = self._parse_criteria(criteria.split())
+        result = [uid for uid, msg in sorted(self._mailbox().messages.items())
+                  if not [f for f in tests if not f(uid, msg)]]
+        self._store.bytes += len(' '.join([str(uid) for uid in result]))
+        return result
+    def _parse_criteria(self, tokens):
+        'convert search keys to [f(uid, msg),] that must all be true'
+        tests = []
+        while tokens:
+            tests.append(self._parse_key(tokens))
+        return tests
+    def _parse_key(self, tokens):
+        key = tokens.pop(0).upper()
+        if key == 'NOT':
+            f = self._parse_key(tokens)
+            return lambda uid, msg: not f(uid, msg)
+        elif key == 'UID':
+            uids = frozenset(self._uids(tokens.pop(0)))
+            return lambda uid, msg: uid in uids
+        elif key == 'ALL':
+            return lambda uid, msg: True
+        elif key in ('SEEN', 'UNSEEN', 'DELETED', 'UNDELETED', 'ANSWERED'):
+            flag = '\\' + key.replace('UN', '').capitalize()
+            if key.startswith('UN'):
+                return lambda uid, msg: flag not in msg[1]
+            return lambda uid, msg: flag in msg[1]
+        raise ValueError('unsupported search key: ' + key)
+
+    def fetch(self, messages, data, modifiers=None):
+        self._store.count('FETCH')
+        return self._fetch(messages, data, modifiers)
+    def _fetch(self, messages, data, modifiers):
+        mailbox = self._mailbox()
+        changedSince = None
+        for modifier in modifiers or ():
+            if modifier.upper().startswith('CHANGEDSINCE'):
+                changedSince = int(modifier.split()[1])
+        results = {}
+        for uid in self._uids(messages):
+            text, flags, modseq = mailbox.messages[uid]
+            if changedSince is not None and modseq <= changedSince:
+                continue
+            d = {'SEQ':uid}
+            for item in data:
+                item = item.upper()
+                name = item.replace('.PEEK', '') # as named in response
+                if item == 'FLAGS':
+                    continue
+                elif item == 'RFC822':
+                    body = text
+                elif name.startswith('BODY[HEADER.FIELDS'):
+                    fields = item[item.index('(') + 1:item.index(')')].split()
+                    body = get_header_fields(text, frozenset(fields))
+                elif name == 'BODY[HEADER]':
+                    body = get_header(text)
+                else:
+                    raise ValueError('unsupported fetch item: ' + item)
+                if '.PEEK' not in item and SEEN not in flags:
+                    flags = flags | set([SEEN])
+                    mailbox.set_flags(uid, flags)
+                d[name] = body
+                self._store.bytes += len(body)
+            d['FLAGS'] = tuple(flags)
+            self._store.bytes += len(' '.join(flags))
+            results[uid] = d
+        if results:
+            self._store.notify()
+        return results
+
+    def _store_flags(self, messages, flags, add=True):
+        mailbox = self._mailbox()
+        for uid in self._uids(messages):
+            if add:
+                mailbox.set_flags(uid, mailbox.messages[uid][1] | set(flags))
+            else:
+                mailbox.set_flags(uid, mailbox.messages[uid][1] - set(flags))
+        self._store.notify()
+    def add_flags(self, messages, flags):
+        self._store.count('STORE')
+        self._store_flags(messages, flags)
+    def remove_flags(self, messages, flags):
+        self._store.count('STORE')
+        self._store_flags(messages, flags, False)
+    def delete_messages(self, messages):
+        self._store.count('STORE')
+        self._store_flags(messages, (DELETED,))
+    def copy(self, messages, folder):
+        self._store.count('COPY')
+        self._copy(messages, folder)
+    def _copy(self, messages, folder):
+        mailbox = self._mailbox()
+        for uid in self._uids(messages):
+            text, flags, modseq = mailbox.messages[uid]
+            self._store.append(folder, text, flags - set([DELETED]))
+    def move(self, messages, folder):
+        self._store.count('MOVE')
+        self._copy(messages, folder)
+        mailbox = self._mailbox()
+        for uid in self._uids(messages):
+            mailbox.remove(uid)
+        self._store.notify()
+    def expunge(self, messages=None):
+        'UID EXPUNGE messages if specified, otherwise EXPUNGE all \\Deleted'
+        mailbox = self._mailbox()
+        if messages is None:
+            self._store.count('EXPUNGE')
+            messages = list(mailbox.messages)
+        else:
+            self._store.count('UID EXPUNGE')
+        for uid in self._uids(messages):
+            if DELETED in mailbox.messages[uid][1]:
+                mailbox.remove(uid)
+        self._store.notify()
+
+    def idle(self):
+        self._store.count('IDLE')
+        mailbox = self._mailbox()
+        mailbox.idlers += 1
+        self._idleSeen = len(mailbox.events)
+    def idle_check(self, timeout=None):
+        '''wait until the mailbox changes; returns responses like
+        [(n, "EXISTS"), (seq, "EXPUNGE"), (seq, "FETCH", ("FLAGS", flags))]
+        or [] on timeout'''
+        mailbox = self._mailbox()
+        with self._store.changed:
+            if len(mailbox.events) == self._idleSeen:
+                self._store.changed.wait(timeout)
+            responses = mailbox.events[self._idleSeen:]
+            self._idleSeen = len(mailbox.events)
+        return responses
+    def idle_done(self):
+        mailbox = self._mailbox()
+        mailbox.idlers -= 1
+        if not mailbox.idlers: # nobody left to report to
+            del mailbox.events[:]
+        self._idleSeen = None
+        return ('IDLE terminated', [])
+
+
+class FakeIMAP4(imaplib.IMAP4):
+    '''imaplib connection to a FakeIMAPClient's store: _command() just
+    queues each command, which the fake server answers in order as
+    the real imaplib response parsing reads its lines'''
+    def __init__(self, client):
+        self._client = client
+        self._queued = [] # [(tag, name, args),] not yet answered
+        imaplib.IMAP4.__init__(self, client._store.host)
+    def open(self, host, port):
+        self._output = '* OK fake IMAP4rev1 server ready\r\n'
+        self._pos = 0 # read position in _output
+    def shutdown(self):
+        pass
+    def _command(self, name, *args):
+        tag = self._new_tag()
+        self.tagged_commands[tag] = None
+        self._queued.append((tag, name, args))
+        return tag
+    def _answer(self):
+        'run the oldest queued command, appending its response to output'
+        tag, name, args = self._queued.pop(0)
+        lines = []
+        if name == 'CAPABILITY':
+            lines.append('* CAPABILITY %s\r\n'
+                         % ' '.join(sorted(self._client._store.capabilities)))
+        elif name == 'UID' and args[0] == 'FETCH':
+            self._client._store.count('FETCH')
+            data = re.findall(r'[^\s\[]+(?:\[[^\]]*\])?', args[2][1:-1])
+            modifiers = [arg[1:-1] for arg in args[3:]]
+            results = self._client._fetch(args[1], data, modifiers)
+            for uid, d in sorted(results.items()):
+                line = '* %d FETCH (UID %d' % (d.pop('SEQ'), uid)
+                flags = d.pop('FLAGS')
+                for item, body in d.items():
+                    line += ' %s {%d}\r\n%s' % (item, len(body), body)
+                lines.append(line + ' FLAGS (%s))\r\n' % ' '.join(flags))
+        else:
+            raise ValueError('unsupported command: ' + name)
+        lines.append('%s OK %s completed\r\n' % (tag, name))
+        self._output = self._output[self._pos:] + ''.join(lines)
+        self._pos = 0
+    def read(self, size):
+        data = self._output[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+    def readline(self):
+        if self._pos == len(self._output) and self._queued:
+            self._answer()
+        i = self._output.find('\n', self._pos) + 1 or len(self._output)
+        return self.read(i - self._pos)
+
+class FakePipelinedIMAPClient(FakeIMAPClient, imap.PipelinedIMAPClient):
+    '''FakeIMAPClient whose fetch_pipelined() is the real one from
+    imap.PipelinedIMAPClient, sending tagged FETCH commands via FakeIMAP4'''
+    def __init__(self, host, *args, **kwargs):
+        FakeIMAPClient.__init__(self, host)
+        self.normalise_times = True
+        self._imap = FakeIMAP4(self)
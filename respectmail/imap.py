@@ -1,4 +1,5 @@
 from imapclient import IMAPClient, SEEN
+from imapclient.response_parser import parse_fetch_response
 import email
 from email.feedparser import FeedParser
 from email.message import Message
@@ -6,6 +7,10 @@ import warnings
 from getpass import getpass
 import socket
 import imaplib
+import time
+import threading
+import Queue
+import db
 
 INBOX = 0
 SENT = 1
@@ -20,17 +25,36 @@ JUNKTRIAGE = 9
 BLACKLIST = 10
 BLACKLISTTRIAGE = 11
 
+# the only headers our triage / thread analysis ever reads
+HEADER_FIELDS = ('from', 'to', 'cc', 'resent-to', 'resent-cc', 'date',
+                 'message-id', 'references', 'in-reply-to', 'subject',
+                 'received')
+
 class IMAPServer(object):
     def __init__(self, host, user, password=None, ssl=True, serverID=1,
                  mboxlist=('INBOX', 'Sent', 'Junk', 'Requests', 'FYI',
                            'Closed', 'Requests', 'FYI',
                            'Closed', 'JunkTriage', 'Blacklist',
                            'StrangersINBOX',), 
-                 **kwargs):
-        'connect to imap server'
-        self.server = RobustClient(host, user, password, ssl=ssl, **kwargs)
+                 incrementalBoxes=(SENT, CLOSED), pipelined=False,
+                 headerFields=HEADER_FIELDS, **kwargs):
+        '''connect to imap server.  Mailboxes listed (by index) in
+        incrementalBoxes are synced incrementally by UID, i.e. only
+        headers of messages added since the last sync are fetched.
+        If pipelined, uses PipelinedClient to keep several FETCH
+        commands in flight at once.  Only the headers listed in
+        headerFields are fetched (with BODY.PEEK, so \\Seen is not set);
+        headerFields=None fetches the complete header'''
+        if pipelined:
+            self.server = PipelinedClient(host, user, password, ssl=ssl,
+                                          **kwargs)
+        else:
+            self.server = RobustClient(host, user, password, ssl=ssl, **kwargs)
         self.mboxlist = mboxlist
+        self.incrementalBoxes = frozenset(incrementalBoxes)
+        self.headerData = header_fetch_data(headerFields)
         self.msgLists = {}
+        self.pendingMoves = {}
         self.serverID = serverID
         self.host = host
         self.user = user
@@ -44,29 +68,59 @@ class IMAPServer(object):
                 print 'Created', mbox, response
 
     def get_updates(self, triageDB, expunge=True):
-        'get INBOX, SENT headers; save to triageDB'
-        msgHeaders = get_headers(self.server, self.mboxlist[INBOX])
-        triageDB.save_headers(msgHeaders, self.mboxlist[INBOX],
-                              serverID=self.serverID)
-        self.msgLists[INBOX] = msgHeaders
-        msgHeaders = get_headers(self.server, self.mboxlist[SENT])
-        triageDB.save_headers(msgHeaders, self.mboxlist[SENT], 
-                              fromMe=True, from_me_f=None,
-                              serverID=self.serverID, verdict=SENT)
-        self.msgLists[SENT] = msgHeaders
-        # update verdicts based on last round of triage by user
-        msgHeaders = get_headers(self.server, self.mboxlist[REQUESTS])
-        triageDB.save_verdicts(msgHeaders, self.mboxlist[REQUESTS], REQUESTS,
-                               serverID=self.serverID)
-        self.msgLists[REQUESTS] = msgHeaders
-        msgHeaders = get_headers(self.server, self.mboxlist[FYI])
-        triageDB.save_verdicts(msgHeaders, self.mboxlist[FYI], FYI,
-                               serverID=self.serverID)
-        self.msgLists[FYI] = msgHeaders
-        msgHeaders = get_headers(self.server, self.mboxlist[CLOSED])
-        triageDB.save_verdicts(msgHeaders, self.mboxlist[CLOSED], CLOSED,
-                               overwrite=False, serverID=self.serverID)
-        self.purge_blacklist(triageDB, expunge)
+        'get INBOX, SENT headers; save to triageDB in one transaction'
+        triageDB.begin_batch()
+        try:
+            for mboxIndex in (INBOX, SENT, REQUESTS, FYI, CLOSED):
+                self.update_folder(triageDB, mboxIndex)
+            self.purge_blacklist(triageDB, expunge)
+        finally:
+            triageDB.end_batch()
+
+    def update_folder(self, triageDB, mboxIndex, saveVerdicts=True):
+        '''get headers from one of INBOX, SENT, REQUESTS, FYI, CLOSED; save.
+        If not saveVerdicts, REQUESTS and FYI are just re-listed (CLOSED
+        is skipped), leaving their verdicts to the next get_updates()'''
+        mbox = self.mboxlist[mboxIndex]
+        if not saveVerdicts and mboxIndex not in (INBOX, SENT):
+            if mboxIndex != CLOSED:
+                self.msgLists[mboxIndex] = get_headers(self.server, mbox,
+                                                       data=self.headerData)
+            return
+        msgHeaders, state = self._get_headers(triageDB, mboxIndex)
+        if mboxIndex == INBOX:
+            triageDB.save_headers(msgHeaders, mbox, serverID=self.serverID)
+        elif mboxIndex == SENT:
+            triageDB.save_headers(msgHeaders, mbox, 
+                                  fromMe=True, from_me_f=None,
+                                  serverID=self.serverID, verdict=SENT)
+        else: # update verdicts based on last round of triage by user
+            triageDB.save_verdicts(msgHeaders, mbox, mboxIndex,
+                                   overwrite=(mboxIndex != CLOSED),
+                                   serverID=self.serverID)
+        self._save_sync_state(triageDB, mboxIndex, state)
+        if mboxIndex != CLOSED:
+            self.msgLists[mboxIndex] = msgHeaders
+
+    def _get_headers(self, triageDB, mboxIndex):
+        '''get headers for the specified mailbox index, either all messages,
+        or (if in incrementalBoxes) only messages new since the last sync.
+        Returns msgHeaders, new sync state (None if not incremental)'''
+        mbox = self.mboxlist[mboxIndex]
+        if mboxIndex not in self.incrementalBoxes:
+            return get_headers(self.server, mbox, data=self.headerData), None
+        state = triageDB.get_sync_state(mbox, self.serverID)
+        msgHeaders, flagChanges, state = sync_headers(self.server, mbox,
+                                                      state, 
+                                                      data=self.headerData)
+        triageDB.save_flags(flagChanges, mbox, self.serverID)
+        return msgHeaders, state
+
+    def _save_sync_state(self, triageDB, mboxIndex, state):
+        'record sync state only after its messages were saved to triageDB'
+        if state is not None:
+            triageDB.save_sync_state(self.mboxlist[mboxIndex], state,
+                                     self.serverID)
 
     def purge_blacklist(self, triageDB, expunge=True):
         '''treat all messages in BLACKLIST/TRIAGE as blacklisted:
@@ -76,79 +130,89 @@ class IMAPServer(object):
                                    expunge)
     def get_blacklist_updates(self, mbox, triageDB, expunge=True):
         'update blacklist verdicts based on user actions, and clear mbox'
-        msgHeaders = get_headers(self.server, mbox)
+        msgHeaders = get_headers(self.server, mbox, data=self.headerData)
         triageDB.save_verdicts(msgHeaders, self.mboxlist[BLACKLIST], BLACKLIST,
                                serverID=self.serverID)
         triageDB.blacklist(msgHeaders)
-        self.server.delete_messages([t[0] for t in msgHeaders])
+        msgList = [t[0] for t in msgHeaders]
+        self.server.delete_messages(msgList)
         if expunge:
-            self.server.expunge()
+            expunge_messages(self.server, msgList)
 
-    def triage(self, triageDB):
-        'triage inbox to request, fyi, junk, blacklist mboxes'
+    def triage(self, triageDB, dryRun=False):
+        '''triage inbox to request, fyi, junk, blacklist mboxes, and move
+        answered messages to CLOSED.  All moves are planned first
+        (see plan_triage()), then executed as one batch.  If dryRun,
+        just print the plan without moving anything.
+        Returns the plan, {fromBox:[(toBox, msgHeaders),]}'''
+        plan = self.plan_triage(triageDB)
+        for fromBox, moves in plan.items():
+            for toBox, msgHeaders in moves:
+                if dryRun:
+                    print 'Would triage %d messages from %s to %s' \
+                          % (len(msgHeaders), fromBox, toBox)
+                else:
+                    self._do_triage(msgHeaders, triageDB, fromBox, toBox)
+        if not dryRun:
+            self.msgLists[INBOX] = [] # all moved out of INBOX
+            self.commit_moves(triageDB)
+        return plan
+
+    def plan_triage(self, triageDB):
+        '''classify INBOX messages in a single pass, and find answered
+        messages in REQUESTS, FYI; returns {fromBox:[(toBox, msgHeaders),]}'''
         requestAddrs, fyiAddrs, junkAddrs, blackAddrs = triageDB.get_triage()
-        fromBox = self.mboxlist[INBOX]
-        msgHeaders = self.msgLists[INBOX]
-        msgSet = set([t[0] for t in msgHeaders])
-        answered = [t for t in msgHeaders 
-                    if '\\Answered' in t[1]._imapFlags or t[1].fromMe]
-        self._do_triage(answered, triageDB, fromBox, 
-                        self.mboxlist[CLOSEDTRIAGE])
-        msgSet -= frozenset([t[0] for t in answered])
-        requests = [t for t in msgHeaders if t[0] in msgSet and 
-                    triageDB.msgThread.get(t[1].uid, None) 
-                    in triageDB.myThreads]
-        self._do_triage(requests, triageDB, fromBox, 
-                        self.mboxlist[REQUESTSTRIAGE])
-        msgSet -= frozenset([t[0] for t in requests])
-        requests = self._do_triage([t for t in msgHeaders if t[0] in msgSet],
-                                   triageDB, fromBox, 
-                                   self.mboxlist[REQUESTSTRIAGE], requestAddrs)
-        msgSet -= frozenset([t[0] for t in requests])
-        fyi = self._do_triage([t for t in msgHeaders if t[0] in msgSet],
-                              triageDB, fromBox, 
-                              self.mboxlist[FYITRIAGE], fyiAddrs)
-        msgSet -= frozenset([t[0] for t in fyi])
-        black = self._do_triage([t for t in msgHeaders if t[0] in msgSet],
-                                triageDB, fromBox, 
-                                self.mboxlist[BLACKLIST], blackAddrs)
-        msgSet -= frozenset([t[0] for t in black])
-        junk = self._do_triage([t for t in msgHeaders if t[0] in msgSet],
-                               triageDB, fromBox, 
-                               self.mboxlist[JUNKTRIAGE], junkAddrs)
-        msgSet -= frozenset([t[0] for t in junk])
-        # move messages from strangers into BLACKLISTTRIAGE mbox
-        strangers = self._do_triage([t for t in msgHeaders if t[0] in msgSet],
-                                    triageDB,
-                                    fromBox, self.mboxlist[BLACKLISTTRIAGE])
-        self.close_answered(triageDB)
-
-    def close_answered(self, triageDB):
-        'move answered messages to CLOSED mailbox and update db'
+        addrIDs = triageDB.get_address_ids(set([a for t in self.msgLists[INBOX]
+                                                for a in get_from(t[1])]))
+        classifier = TriageClassifier(requestAddrs, fyiAddrs, junkAddrs,
+                                      blackAddrs, triageDB.msgThread,
+                                      triageDB.myThreads, addrIDs)
+        plan = {}
+        def add_moves(fromBox, toBox, msgHeaders):
+            for t in plan.setdefault(fromBox, []):
+                if t[0] == toBox: # several indexes may share one mailbox
+                    t[1].extend(msgHeaders)
+                    return
+            plan[fromBox].append((toBox, list(msgHeaders)))
+        destinations = classifier.classify_all(self.msgLists[INBOX])
+        for mboxIndex in TriageClassifier.destinations:
+            if mboxIndex in destinations:
+                add_moves(self.mboxlist[INBOX], self.mboxlist[mboxIndex],
+                          destinations[mboxIndex])
         answered = triageDB.get_answered_messages()
-        msgHeaders = filter_message_ids(self.msgLists[REQUESTS], answered)
-        self._do_triage(msgHeaders, triageDB, self.mboxlist[REQUESTS], 
-                        self.mboxlist[CLOSED])
-        msgHeaders = filter_message_ids(self.msgLists[FYI], answered)
-        self._do_triage(msgHeaders, triageDB, self.mboxlist[FYI], 
-                        self.mboxlist[CLOSED])
+        for mboxIndex in (REQUESTS, FYI): # move answered messages to CLOSED
+            msgHeaders = filter_message_ids(self.msgLists[mboxIndex], answered)
+            if msgHeaders:
+                add_moves(self.mboxlist[mboxIndex], self.mboxlist[CLOSED],
+                          msgHeaders)
+        return plan
 
     def _do_triage(self, msgHeaders, triageDB, fromBox, toBox, addrs=None):
-        'move msgs (subset from addrs if specified) to toBox'
+        '''schedule move of msgs (subset from addrs if specified) to toBox;
+        commit_moves() performs all scheduled moves'''
         if addrs:
             msgHeaders = filter_message_addrs(msgHeaders, addrs)
         if not msgHeaders:
             return ()
         print 'Triaging %d messages to %s...' % (len(msgHeaders), toBox)
-        move_messages(self.server, msgHeaders, fromBox, toBox)
-        triageDB.save_moves(msgHeaders, toBox)
+        self.pendingMoves.setdefault(fromBox, []).append((toBox, msgHeaders))
         return msgHeaders
 
+    def commit_moves(self, triageDB, expunge=True):
+        '''perform all scheduled moves, selecting and expunging each
+        source mailbox only once, and record them in triageDB'''
+        for fromBox, moves in self.pendingMoves.items():
+            batch_move_messages(self.server, fromBox, moves, expunge)
+            for toBox, msgHeaders in moves:
+                triageDB.save_moves(msgHeaders, toBox)
+            del self.pendingMoves[fromBox]
+
     def _rescue_update(self, triageDB):
         'recreate last update state (without any db change), ready for triage'
         if not hasattr(triageDB, 'myThreads'):
             triageDB._load_threads()
-        msgHeaders = get_headers(self.server, self.mboxlist[INBOX])
+        msgHeaders = get_headers(self.server, self.mboxlist[INBOX],
+                                 data=self.headerData)
         l = []
         for j,msg in msgHeaders:
             triageDB.cursor.execute('select id from messages where msgid=?',
@@ -158,19 +222,66 @@ class IMAPServer(object):
                 msg.uid = t[0]
                 l.append((j,msg))
         self.msgLists[INBOX] = l
-        msgHeaders = get_headers(self.server, self.mboxlist[REQUESTS])
+        msgHeaders = get_headers(self.server, self.mboxlist[REQUESTS],
+                                 data=self.headerData)
         self.msgLists[REQUESTS] = msgHeaders
-        msgHeaders = get_headers(self.server, self.mboxlist[FYI])
+        msgHeaders = get_headers(self.server, self.mboxlist[FYI],
+                                 data=self.headerData)
         self.msgLists[FYI] = msgHeaders
 
     def get_messages(self, mbox='Drafts'):
         'get full-text email message objects'
         return get_headers(self.server, mbox, data='RFC822', 
-                           preserveState=False)
+                           preserveState=False,
+                           factory=message_from_string_safe)
         
 def get_from(msg):
-    origin = email.utils.getaddresses(msg.get_all('from', []))
-    return frozenset([t[1].lower() for t in origin])
+    'get frozenset of lowercase From addresses (parsed via a cache)'
+    return db.parse_addresses(msg.get_all('from', []))
+
+class TriageClassifier(object):
+    '''assigns each INBOX message its triage destination in one pass,
+    in priority order: answered by me, in one of my threads, then by
+    sender: request, fyi, blacklist, junk addresses; else strangers.
+    If addrIDs {email:id} is given, the address sets are of address ids
+    (as from TriageDB.get_triage()), else of email addresses'''
+    destinations = (CLOSEDTRIAGE, REQUESTSTRIAGE, FYITRIAGE, BLACKLIST,
+                    JUNKTRIAGE, BLACKLISTTRIAGE)
+    def __init__(self, requestAddrs, fyiAddrs, junkAddrs, blackAddrs,
+                 msgThread, myThreads, addrIDs=None):
+        self.msgThread = msgThread
+        self.myThreads = myThreads
+        self.addrIDs = addrIDs
+        self.addrRank = {} # {addr:rank}, lowest rank has highest priority
+        self.rankDest = (REQUESTSTRIAGE, FYITRIAGE, BLACKLIST, JUNKTRIAGE,
+                         BLACKLISTTRIAGE)
+        for rank, addrs in reversed(list(enumerate((requestAddrs, fyiAddrs,
+                                                    blackAddrs, junkAddrs)))):
+            for a in addrs:
+                self.addrRank[a] = rank
+        self.defaultRank = len(self.rankDest) - 1
+
+    def classify(self, msg, fromAddrs):
+        'get destination mbox index for msg with sender key fromAddrs'
+        if '\\Answered' in msg._imapFlags or msg.fromMe:
+            return CLOSEDTRIAGE
+        if self.msgThread.get(msg.uid, None) in self.myThreads:
+            return REQUESTSTRIAGE
+        rank = self.defaultRank
+        for a in fromAddrs:
+            rank = min(rank, self.addrRank.get(a, rank))
+        return self.rankDest[rank]
+
+    def classify_all(self, msgHeaders):
+        'returns {mboxIndex:[(serverMsg, msg),]}'
+        d = {}
+        for t in msgHeaders:
+            fromAddrs = get_from(t[1])
+            if self.addrIDs is not None:
+                fromAddrs = [self.addrIDs[a] for a in fromAddrs
+                             if a in self.addrIDs]
+            d.setdefault(self.classify(t[1], fromAddrs), []).append(t)
+        return d
 
 def filter_message_addrs(msgHeaders, addrs):
     'filter messages to those from specified addrs'
@@ -199,34 +310,183 @@ def message_from_string_safe(text):
         feedparser.feed(text)
         return feedparser.close()
 
+class HeaderRecord(object):
+    '''compact stand-in for email.message.Message, for message headers only.
+    Keeps the raw header text until first access, then parses it into
+    a tuple of (lowercase name, value) pairs.  Supports the read-only
+    Message interface used by triage: len(), [], get(), get_all(), items()'''
+    __slots__ = ('_text', '_headers', '_imapFlags', 'uid', 'fromMe')
+    def __init__(self, text):
+        self._text = text
+        self._headers = None
+        self.uid = None
+        self.fromMe = None
+    def _get_headers(self):
+        'parse header text on first access'
+        if self._headers is None:
+            headers = []
+            for line in self._text.splitlines(True):
+                if not line.strip(): # end of header
+                    break
+                if line[0] in ' \t': # continuation of folded header
+                    if headers:
+                        headers[-1][1].append(line)
+                    continue
+                i = line.find(':')
+                if i > 0:
+                    headers.append((line[:i].lower(), [line[i + 1:].lstrip()]))
+            self._headers = tuple([(k, ''.join(v).rstrip('\r\n'))
+                                   for k,v in headers])
+            self._text = None
+        return self._headers
+    def __len__(self):
+        return len(self._get_headers())
+    def __contains__(self, name):
+        name = name.lower()
+        for k,v in self._get_headers():
+            if k == name:
+                return True
+        return False
+    def __getitem__(self, name):
+        'like Message, returns None if header not present'
+        return self.get(name)
+    def get(self, name, failobj=None):
+        name = name.lower()
+        for k,v in self._get_headers():
+            if k == name:
+                return v
+        return failobj
+    def get_all(self, name, failobj=None):
+        name = name.lower()
+        values = [v for k,v in self._get_headers() if k == name]
+        return values or failobj
+    def keys(self):
+        return [k for k,v in self._get_headers()]
+    def items(self):
+        return list(self._get_headers())
+
+def header_fetch_data(headerFields=HEADER_FIELDS):
+    '''get FETCH data item for just headerFields, using BODY.PEEK so the
+    message is not marked \\Seen; None means the complete header'''
+    if headerFields is None:
+        return 'BODY[HEADER]'
+    return 'BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(headerFields).upper()
+
+def get_fetch_body(m, data):
+    '''get body data from a fetch() response dict; the server answers
+    BODY.PEEK[...] as BODY[...] and may reformat the field list'''
+    try:
+        return m[data]
+    except KeyError:
+        for k,v in m.items():
+            if k.startswith('BODY['):
+                return v
+        raise
+
+def fetch_headers(server, msgList, maxreq=200, data='BODY[HEADER]',
+                  factory=HeaderRecord):
+    '''fetch headers for msgList in chunks, return as [(serverID,message_obj),]
+    where message_obj is created by factory(text)'''
+    msgHeaders = []
+    for msgDict in server.fetch_chunks(msgList, ['FLAGS', data], maxreq):
+        for j,m in msgDict.iteritems():
+            msg = factory(get_fetch_body(m, data))
+            msg._imapFlags = m['FLAGS']
+            msgHeaders.append((j,msg))
+    return msgHeaders
+
 def get_headers(server, mailbox='INBOX', maxreq=200, data='BODY[HEADER]',
-                preserveState=True):
-    'retrieve headers for a mailbox, return as [(serverID,message_obj),]'
+                preserveState=True, factory=HeaderRecord):
+    '''retrieve headers for a mailbox, return as [(serverID,message_obj),].
+    preserveState restores UNSEEN flags (unnecessary for BODY.PEEK)'''
+    preserveState = preserveState and '.PEEK[' not in data
     server.select_folder(mailbox)
     if preserveState:
         unseen = server.search('UNSEEN') # preserve UNSEEN state
     msgList = server.search(['NOT DELETED'])
-    msgHeaders = []
-    for i in range(0, len(msgList), maxreq):
-        msgDict = server.fetch(msgList[i:i + maxreq], ['FLAGS', data])
-        for j,m in msgDict.iteritems():
-            msg = message_from_string_safe(m[data])
-            msg._imapFlags = m['FLAGS']
-            msgHeaders.append((j,msg))
+    msgHeaders = fetch_headers(server, msgList, maxreq, data, factory)
     if preserveState:
         server.remove_flags(unseen, [SEEN]) # reset back to unseen state
     return msgHeaders
 
+def sync_headers(server, mailbox='INBOX', state=None, maxreq=200,
+                 data='BODY[HEADER]', preserveState=True):
+    '''retrieve headers only for messages added since the last sync.
+    state is (uidvalidity, lastUID, modseq) saved from the previous sync,
+    or None.  If UIDVALIDITY changed, falls back to a full resync.
+    If the server supports CONDSTORE, also gets {uid:flags} for old
+    messages whose flags changed since modseq.
+    Returns msgHeaders, flagChanges, newState'''
+    preserveState = preserveState and '.PEEK[' not in data
+    modseq = None
+    if server.has_capability('CONDSTORE'):
+        # STATUS (HIGHESTMODSEQ) is itself a CONDSTORE enabling command
+        # (RFC 7162 section 3.1), so no separate ENABLE is needed
+        status = server.folder_status(mailbox, ['HIGHESTMODSEQ'])
+        modseq = status.get('HIGHESTMODSEQ', None)
+    response = server.select_folder(mailbox)
+    uidvalidity = response.get('UIDVALIDITY', None)
+    if state is None or uidvalidity is None or state[0] != uidvalidity:
+        lastUID = 0 # UIDs no longer valid, so must do full resync
+        lastModseq = None
+    else:
+        lastUID, lastModseq = state[1:]
+    flagChanges = {}
+    if lastUID and lastModseq and modseq and modseq > lastModseq:
+        msgDict = server.fetch('1:%d' % lastUID, ['FLAGS'],
+                               modifiers=['CHANGEDSINCE %d' % lastModseq])
+        for j,m in msgDict.iteritems():
+            flagChanges[j] = m['FLAGS']
+    uidRange = ['UID', '%d:*' % (lastUID + 1)]
+    if preserveState:
+        unseen = server.search(uidRange + ['UNSEEN']) # preserve UNSEEN state
+    # n:* always matches the last message, even if its UID is below n
+    msgList = [j for j in server.search(uidRange + ['NOT', 'DELETED'])
+               if j > lastUID]
+    msgHeaders = fetch_headers(server, msgList, maxreq, data)
+    if preserveState:
+        unseen = [j for j in unseen if j > lastUID]
+        if unseen:
+            server.remove_flags(unseen, [SEEN]) # reset back to unseen state
+    if msgList:
+        lastUID = max(msgList)
+    return msgHeaders, flagChanges, (uidvalidity, lastUID, modseq)
+
 
 
 def move_messages(server, msgHeaders, fromBox='INBOX', toBox='Junk',
                   expunge=True):
-    'copy the specified messages to toBox, then delete from fromBox'
+    'move the specified messages from fromBox to toBox'
+    batch_move_messages(server, fromBox, [(toBox, msgHeaders)], expunge)
+
+def batch_move_messages(server, fromBox, moves, expunge=True):
+    '''move messages out of fromBox, given as [(toBox, msgHeaders),],
+    selecting fromBox once.  Uses MOVE (RFC 6851) if the server supports it;
+    otherwise copies, marks deleted and expunges once at the end'''
     server.select_folder(fromBox)
-    msgList = [t[0] for t in msgHeaders]
-    server.copy(msgList, toBox)
-    server.delete_messages(msgList)
-    if expunge:
+    useMove = server.has_capability('MOVE')
+    deleted = []
+    for toBox, msgHeaders in moves:
+        msgList = [t[0] for t in msgHeaders]
+        if not msgList:
+            continue
+        if useMove:
+            server.move(msgList, toBox)
+        else:
+            server.copy(msgList, toBox)
+            server.delete_messages(msgList)
+            deleted += msgList
+    if expunge and deleted:
+        expunge_messages(server, deleted)
+
+def expunge_messages(server, msgList):
+    '''expunge only msgList using UID EXPUNGE (UIDPLUS) if possible,
+    so we do not expunge messages deleted by other clients'''
+    if not msgList:
+        return
+    if server.has_capability('UIDPLUS'):
+        server.expunge(msgList)
+    else:
         server.expunge()
 
 def ensure_folder(server, foldername):
@@ -236,8 +496,51 @@ def ensure_folder(server, foldername):
             return False
     return server.create_folder(foldername)
 
+class PipelinedIMAPClient(IMAPClient):
+    'IMAPClient that can keep several tagged FETCH commands in flight'
+    def fetch_pipelined(self, messages, data, maxreq=200, depth=4,
+                        modifiers=None):
+        '''fetch messages in chunks of maxreq, with up to depth FETCH
+        commands outstanding at once, so high-latency links stay busy.
+        Returns {msgID:{attr:value}} just like fetch()'''
+        messages = list(messages)
+        args = ['(%s)' % ' '.join(data).upper()]
+        if modifiers:
+            args.append('(%s)' % ' '.join(modifiers))
+        if self.use_uid:
+            command = ('UID', 'FETCH')
+        else:
+            command = ('FETCH',)
+        chunks = [messages[i:i + maxreq]
+                  for i in range(0, len(messages), maxreq)]
+        tags = []
+        responses = []
+        results = {}
+        for i in range(len(chunks) + depth):
+            if i < len(chunks): # send next command before waiting
+                msgSet = ','.join([str(j) for j in chunks[i]])
+                tags.append(self._imap._command(*(command + (msgSet,) 
+                                                  + tuple(args))))
+            if i >= depth - 1 and tags: # wait for oldest command
+                typ, dat = self._imap._command_complete('FETCH', tags.pop(0))
+                self._checkok('fetch', typ, dat)
+                typ, dat = self._imap._untagged_response(typ, dat, 'FETCH')
+                if dat != [None]:
+                    responses += dat
+        if responses:
+            results.update(parse_fetch_response(responses, 
+                                                self.normalise_times,
+                                                self.use_uid))
+        return results
+
 class RobustClient(object):
-    'IMAP connection that auto-retries after socket.error'
+    '''pool of IMAP connections to one server that auto-retries after
+    socket.error.  Each pooled connection stays selected on the folder
+    it last used, so switching among up to maxConnections hot folders
+    needs no SELECT round trip'''
+    clientClass = IMAPClient
+    topLevel = ('list_folders', 'create_folder', 'select_folder',
+                'has_capability', 'folder_status')
     def __init__(self, host, user, password=None, immediateLogin=False,
                  *args, **kwargs):
         self._host = host
@@ -246,44 +549,158 @@ class RobustClient(object):
             password = getpass('Enter password for %s on %s:' %
                                (user, host))
         self._password = password
+        self._maxConnections = kwargs.pop('maxConnections', 3)
+        self._maxDelay = kwargs.pop('maxDelay', 300) # reconnect backoff
         self._args = args
         self._kwargs = kwargs
+        self._pool = [] # connections, least recently used first
+        self._folders = {} # {connection:(folder, select response)}
+        self._spares = Queue.Queue() # connections from background login
+        self._reconnecting = threading.Event()
         if immediateLogin:
             self._connect()
+    def _login(self):
+        'open and login a new IMAPClient connection'
+        server = self.clientClass(self._host, *self._args, **self._kwargs)
+        server.login(self._user, self._password)
+        return server
+    def _use(self, server):
+        'make server the current connection, most recently used in pool'
+        if server not in self._folders:
+            self._folders[server] = (None, None)
+        else:
+            self._pool.remove(server)
+        self._pool.append(server)
+        self._server = server
     def _connect(self):
-        'login to IMAP server'
-        self._server = IMAPClient(self._host, *self._args, **self._kwargs)
-        self._server.login(self._user, self._password)
+        'login to IMAP server, adding a new current connection to the pool'
+        try:
+            server = self._spares.get_nowait() # from background reconnect
+        except Queue.Empty:
+            server = self._login()
+        self._use(server)
+    def _drop(self, server):
+        'remove a dead connection from the pool, return its (folder, response)'
+        self._pool.remove(server)
+        if getattr(self, '_server', None) is server:
+            del self._server
+        return self._folders.pop(server)
+    def _reconnect(self):
+        '''wait for a new current connection, while a background thread
+        retries login with exponential backoff'''
+        if not self._reconnecting.is_set():
+            self._reconnecting.set()
+            t = threading.Thread(target=self._reconnect_loop)
+            t.daemon = True
+            t.start()
+        while True:
+            try: # timeout keeps us responsive to KeyboardInterrupt
+                server = self._spares.get(True, 1.)
+            except Queue.Empty:
+                continue
+            self._use(server)
+            return
+    def _reconnect_loop(self):
+        'login in background until it succeeds, backing off after failures'
+        delay = 1
+        while True:
+            try:
+                self._spares.put(self._login())
+            except Exception:
+                print 'Reconnect to %s failed.  Retrying in %d sec...' \
+                      % (self._host, delay)
+                time.sleep(delay)
+                delay = min(2 * delay, self._maxDelay)
+            else:
+                break
+        self._reconnecting.clear()
+    def clone(self):
+        '''get a new (not yet connected) single-connection client, same
+        login and client class'''
+        client = RobustClient(self._host, self._user, self._password,
+                              False, maxConnections=1,
+                              maxDelay=self._maxDelay,
+                              *self._args, **self._kwargs)
+        client.clientClass = self.clientClass
+        return client
     def _disconnect(self):
-        '''drop IMAPClient connection, e.g. to prevent socket timeout
+        '''drop all IMAPClient connections, e.g. to prevent socket timeout
         (any method call will automatically reconnect)'''
-        self._server.logout()
-        del self._server
+        for server in self._pool[:]:
+            self._drop(server)
+            server.logout()
     def _robust_call(self, funcName, *args, **kwargs):
         'perform IMAPClient call, restoring server connection if necessary'
-        topLevel = ('list_folders', 'create_folder', 'select_folder')
         if not hasattr(self, '_server'): # connect just-in-time
             self._connect()
         while True:
-            func = getattr(self._server, funcName)
+            server = self._server
             try:
-                return func(*args, **kwargs)
+                return getattr(server, funcName)(*args, **kwargs)
             except (socket.error, imaplib.IMAP4.abort):
                 print 'socket error for %s.  Retrying...' % self._host
-                while True:
-                    try:
-                        self._connect()
-                    except:
-                        raw_input('Reconnect failed. Check network and hit enter to retry...')
-                    else:
-                        break
-                if funcName not in topLevel: # must reconnect current folder
-                    self._server.select_folder(self._folder)
+                folder, response = self._drop(server)
+                self._reconnect()
+                if funcName not in self.topLevel and folder is not None:
+                    response = self._server.select_folder(folder) # restore
+                    self._folders[self._server] = (folder, response)
+    def idle_loop(self, folder, callback, renew=1500, poll=30):
+        '''hold an IDLE on folder forever, calling callback() whenever the
+        server reports a change.  IDLE is renewed every renew seconds
+        (RFC 2177 servers may drop it after 30 min).  After a dropped
+        connection, reconnects with exponential backoff, then calls
+        callback() to catch any changes missed while offline'''
+        delay = 1
+        reconnected = False
+        while True:
+            try:
+                if not hasattr(self, '_server'):
+                    self._connect()
+                self._server.select_folder(folder)
+                self._folders[self._server] = (folder, None)
+                if reconnected:
+                    callback()
+                    reconnected = False
+                self._server.idle()
+                try:
+                    start = time.time()
+                    while time.time() - start < renew:
+                        if self._server.idle_check(poll):
+                            callback()
+                finally:
+                    self._server.idle_done()
+                delay = 1
+            except (socket.error, imaplib.IMAP4.abort):
+                print 'IDLE on %s %s dropped.  Reconnecting in %d sec...' \
+                      % (self._host, folder, delay)
+                if hasattr(self, '_server'):
+                    self._drop(self._server)
+                time.sleep(delay)
+                delay = min(2 * delay, self._maxDelay)
+                reconnected = True
     # proxy the IMAPClient methods...
+    def fetch_chunks(self, msgList, data, maxreq=200):
+        'fetch msgList in chunks of maxreq; yields one fetch() dict per chunk'
+        for i in range(0, len(msgList), maxreq):
+            yield self.fetch(msgList[i:i + maxreq], data)
     def select_folder(self, folder, *args, **kwargs):
-        'remember folder name in case we need to restore connection'
+        '''switch to a pooled connection that already has folder selected;
+        otherwise SELECT it on a new or the least recently used connection'''
+        if not args and not kwargs:
+            for server in self._pool:
+                if self._folders[server][0] == folder:
+                    self._use(server)
+                    return self._folders[server][1]
+        unselected = [server for server in self._pool
+                      if self._folders[server][0] is None]
+        if unselected:
+            self._use(unselected[0])
+        elif len(self._pool) < self._maxConnections:
+            self._connect()
+        else:
+            self._use(self._pool[0])
         response = self._robust_call('select_folder', folder, *args, **kwargs)
-        self._folder = folder
+        self._folders[self._server] = (folder, response)
         return response
     list_folders = lambda self, *args, **kwargs: \
       self._robust_call('list_folders', *args, **kwargs)
@@ -301,6 +718,27 @@ class RobustClient(object):
       self._robust_call('remove_flags', *args, **kwargs)
     copy = lambda self, *args, **kwargs: \
       self._robust_call('copy', *args, **kwargs)
+    move = lambda self, *args, **kwargs: \
+      self._robust_call('move', *args, **kwargs)
+    has_capability = lambda self, *args, **kwargs: \
+      self._robust_call('has_capability', *args, **kwargs)
+    folder_status = lambda self, *args, **kwargs: \
+      self._robust_call('folder_status', *args, **kwargs)
+
+class PipelinedClient(RobustClient):
+    '''RobustClient that pipelines chunked FETCH commands: keeps up to
+    depth FETCH commands in flight on one connection'''
+    clientClass = PipelinedIMAPClient
+    def __init__(self, host, user, password=None, immediateLogin=False,
+                 depth=4, *args, **kwargs):
+        self._depth = depth
+        RobustClient.__init__(self, host, user, password, immediateLogin,
+                              *args, **kwargs)
+    def fetch_chunks(self, msgList, data, maxreq=200):
+        'fetch all of msgList using pipelined FETCH commands'
+        if msgList:
+            yield self._robust_call('fetch_pipelined', msgList, data, maxreq,
+                                    self._depth)
 
 #md = mailbox.Maildir('maildirtest')
 #    localID = md.add(msg)
@@ -1,4 +1,5 @@
 import smtplib
+from imap import expunge_messages
 from email.mime.text import MIMEText
 from getpass import getpass
 
@@ -65,7 +66,7 @@ def apply_templates(srv, smtpServer, templateDict, msgList, expunge=True):
         print 'Sent %d template messages on %s' % (len(msgSent), srv.host)
         srv.server.delete_messages(msgSent)
         if expunge:
-            srv.server.expunge()
+            expunge_messages(srv.server, msgSent)
 
 def send_all_templates(servers, host, user, mbox='Drafts', expunge=True):
     'send all template messages on the specified servers'
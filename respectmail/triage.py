@@ -1,3 +1,7 @@
+import sys
+import time
+import threading
+import Queue
 import db
 import imap
 import send
@@ -12,23 +16,98 @@ def get_servers():
         sys.path.append(os.getcwd()) # look for config in current dir
         import config
     servers = config.mailServers
-    return servers, getattr(config, 'smtpKwargs', {})
+    return servers, getattr(config, 'smtpKwargs', {}), \
+           getattr(config, 'triageKwargs', {})
 
-def do_triage(servers):
-    'analyze incoming mail and perform candidate triage'
+class SerialDBProxy(object):
+    '''forwards TriageDB method calls from worker threads to the single
+    thread that owns the TriageDB (sqlite3 connections cannot be shared
+    across threads).  Plain attributes are read directly.'''
+    def __init__(self, triageDB, requests):
+        self._triageDB = triageDB
+        self._requests = requests
+    def __getattr__(self, attr):
+        v = getattr(self._triageDB, attr)
+        if not callable(v):
+            return v
+        def call(*args, **kwargs):
+            reply = Queue.Queue(1)
+            self._requests.put((attr, args, kwargs, reply))
+            success, result = reply.get()
+            if not success:
+                raise result[0], result[1], result[2]
+            return result
+        return call
+
+def run_parallel(servers, triageDB, methodName, maxPerHost=1):
+    '''call srv.methodName(triageDB) for all servers concurrently,
+    with at most maxPerHost concurrent connections to any one host.
+    The calling thread is the single writer that executes all TriageDB
+    calls made by the server threads.'''
+    requests = Queue.Queue()
+    proxy = SerialDBProxy(triageDB, requests)
+    hostLimits = {}
+    for srv in servers:
+        if srv.host not in hostLimits:
+            hostLimits[srv.host] = threading.BoundedSemaphore(maxPerHost)
+    errors = []
+    def worker(srv):
+        try:
+            with hostLimits[srv.host]:
+                getattr(srv, methodName)(proxy)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            requests.put(None) # signal that this server is done
+    threads = [threading.Thread(target=worker, args=(srv,)) 
+               for srv in servers]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    running = len(threads)
+    while running:
+        try: # timeout keeps us responsive to KeyboardInterrupt
+            request = requests.get(True, 1.)
+        except Queue.Empty:
+            continue
+        if request is None:
+            running -= 1
+            continue
+        attr, args, kwargs, reply = request
+        try:
+            reply.put((True, getattr(triageDB, attr)(*args, **kwargs)))
+        except Exception:
+            reply.put((False, sys.exc_info()))
+    for t in threads:
+        t.join()
+    if errors: # re-raise first failure in our thread
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+def do_triage(servers, parallel=False, maxPerHost=1):
+    '''analyze incoming mail and perform candidate triage.
+    If parallel, all servers are synced (and triaged) concurrently.'''
     triageDB = db.TriageDB()
-    for s in servers:
-        print 'getting updates from %s...' % s.host
-        s.get_updates(triageDB)
+    if parallel:
+        print 'getting updates from %s...' % ', '.join([s.host for s in servers])
+        run_parallel(servers, triageDB, 'get_updates', maxPerHost)
+    else:
+        for s in servers:
+            print 'getting updates from %s...' % s.host
+            s.get_updates(triageDB)
+    # global thread analysis only after every server has reported
     triageDB.update_threads((imap.REQUESTS, imap.FYI, imap.CLOSED))
-    for s in servers:
-        print 'triaging messages on %s...' % s.host
-        s.triage(triageDB)
+    if parallel:
+        print 'triaging messages on %s...' % ', '.join([s.host for s in servers])
+        run_parallel(servers, triageDB, 'triage', maxPerHost)
+    else:
+        for s in servers:
+            print 'triaging messages on %s...' % s.host
+            s.triage(triageDB)
     return triageDB
 
-def triage_ask_purge(servers, smtpKwargs):
+def triage_ask_purge(servers, smtpKwargs, **triageKwargs):
     'triage, then give user a chance to reclassify, and finally purge spam'
-    triageDB = do_triage(servers)
+    triageDB = do_triage(servers, **triageKwargs)
     for srv in servers:
         srv.server._disconnect() # avoid socket timeout in case user delays
     d = dict(btname=servers[0].mboxlist[imap.BLACKLISTTRIAGE],
@@ -49,14 +128,72 @@ in %(btname)s will be blacklisted.
             srv.purge_blacklist(triageDB)
             srv.server._disconnect() # go offline to avoid socket timeout
 
-def repeat_triage_until_exit(servers, smtpKwargs):
+def repeat_triage_until_exit(servers, smtpKwargs, **triageKwargs):
     'let user triage incoming email over & over (enter password only once)'
     while True:
-        triage_ask_purge(servers, smtpKwargs)
+        triage_ask_purge(servers, smtpKwargs, **triageKwargs)
         confirm = raw_input('''Hit enter to re-connect and triage new messages, or enter X to exit: ''')
         if confirm.lower() == 'x':
             return
             
+def watch_folders(servers, events, folders):
+    '''start a thread per (server, folder) holding an IDLE connection;
+    each reported change puts (server, folder index) on events queue'''
+    threads = []
+    for srv in servers:
+        for mboxIndex in folders:
+            client = srv.server.clone()
+            callback = lambda srv=srv, mboxIndex=mboxIndex: \
+                       events.put((srv, mboxIndex))
+            t = threading.Thread(target=client.idle_loop,
+                                 args=(srv.mboxlist[mboxIndex], callback))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+    return threads
+
+def triage_daemon(servers, folders=(imap.INBOX, imap.SENT, imap.REQUESTS,
+                                    imap.FYI, imap.BLACKLIST),
+                  settle=2., goodVerdicts=(imap.REQUESTS, imap.FYI,
+                                           imap.CLOSED)):
+    '''run one full triage, then stay connected via IMAP IDLE, ingesting
+    and triaging just the new messages in folders as soon as they arrive.
+    The thread graph and sender counts are kept in memory and updated
+    incrementally.  StrangersINBOX is never purged automatically.
+    Since its own triage moves land in REQUESTS, FYI and CLOSED, those
+    are only re-listed here; the user's verdicts in them are recorded
+    by the next full triage round.  Runs until interrupted (Ctrl-C).'''
+    triageDB = do_triage(servers)
+    events = Queue.Queue()
+    watch_folders(servers, events, folders)
+    print 'waiting for new messages (Ctrl-C to exit)...'
+    while True:
+        try: # timeout keeps us responsive to KeyboardInterrupt
+            changes = [events.get(True, 1.)]
+        except Queue.Empty:
+            continue
+        time.sleep(settle) # let a burst of changes arrive, then handle all
+        while True:
+            try:
+                changes.append(events.get_nowait())
+            except Queue.Empty:
+                break
+        changed = {}
+        for srv, mboxIndex in changes:
+            changed.setdefault(srv, set()).add(mboxIndex)
+        for srv, mboxIndexes in changed.items():
+            for mboxIndex in (imap.INBOX, imap.SENT, imap.REQUESTS,
+                              imap.FYI):
+                if mboxIndex in mboxIndexes:
+                    srv.update_folder(triageDB, mboxIndex, saveVerdicts=False)
+            if imap.BLACKLIST in mboxIndexes:
+                srv.get_blacklist_updates(srv.mboxlist[imap.BLACKLIST],
+                                          triageDB)
+        triageDB.update_threads(goodVerdicts)
+        for srv in changed:
+            print 'triaging new messages on %s...' % srv.host
+            srv.triage(triageDB)
+
 if __name__ == '__main__':
-    servers, smtpKwargs = get_servers()
-    repeat_triage_until_exit(servers, smtpKwargs)
+    servers, smtpKwargs, triageKwargs = get_servers()
+    repeat_triage_until_exit(servers, smtpKwargs, **triageKwargs)